@@ -0,0 +1,122 @@
+import logging
+import os
+import queue
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from qemucommand import QemuCommand
+from testutils import qemu_boot_args, qemu_start, qemu_terminate, guest_session
+
+logger = logging.getLogger("selftest")
+
+
+class Guest(object):
+    """
+    One VM of a fleet, with its own overlay, ports and MAC address.
+    """
+
+    def __init__(self, index, qemu, process, monitor):
+        self.index = index
+        self.qemu = qemu
+        self.process = process
+        self.monitor = monitor
+        self.ready = False
+
+    @property
+    def ssh_port(self):
+        return self.qemu.ssh_port
+
+    def command(self, command, timeout=120):
+        return guest_session(self.qemu.ssh_port).run(command, timeout=timeout)
+
+    def terminate(self):
+        qemu_terminate(self.process)
+
+
+class QemuFleet(object):
+    """
+    Boot 'size' isolated guests of an already built image concurrently and
+    distribute work over them. Each guest gets a qcow2 overlay of its own
+    in 'workdir', so that the guests neither share state nor modify the
+    deployed image, and unique ssh/serial ports and MAC addresses.
+
+    Use it as a context manager:
+
+        with QemuFleet('core-image-minimal', 4, machine='qemux86-64') as fleet:
+            results = fleet.map(check, cases)
+
+    where check(guest, case) runs on whichever guest is free next.
+    """
+
+    def __init__(self, imagename, size, workdir=None, boot_timeout=300, **kwargs):
+        self.imagename = imagename
+        self.size = size
+        self.boot_timeout = boot_timeout
+        self.kwargs = kwargs
+        self.guests = []
+        self._own_workdir = workdir is None
+        self.workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix='ota-fleet-', dir=os.getcwd()))
+        self._free = queue.Queue()
+
+    def __enter__(self):
+        try:
+            self.boot()
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def boot(self):
+        os.makedirs(self.workdir, exist_ok=True)
+        for index in range(self.size):
+            overlay = os.path.join(self.workdir, 'guest-%d.cow' % index)
+            args = qemu_boot_args(self.imagename, overlay=overlay, **self.kwargs)
+            qemu = QemuCommand(args)
+            process, monitor = qemu_start(qemu)
+            guest = Guest(index, qemu, process, monitor)
+            self.guests.append(guest)
+        print('Booting %d guests of %s...' % (self.size, self.imagename))
+
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            ready = list(executor.map(lambda guest: guest.monitor.wait(timeout=self.boot_timeout), self.guests))
+        for guest, ok in zip(self.guests, ready):
+            guest.ready = ok
+            if ok:
+                self._free.put(guest)
+            else:
+                logger.warning('Guest %d did not become reachable over ssh. Last console output:\n%s' %
+                               (guest.index, guest.monitor.console_tail()))
+        if self._free.empty():
+            raise RuntimeError('None of the %d guests booted' % self.size)
+
+    def _run(self, func, item):
+        guest = self._free.get()
+        try:
+            return func(guest, item)
+        finally:
+            self._free.put(guest)
+
+    def map(self, func, items):
+        """
+        Call func(guest, item) for every item, each on a guest that is not
+        busy with another item, and return the results in the order of
+        'items'. An exception raised by func is raised again here.
+        """
+        workers = len([guest for guest in self.guests if guest.ready])
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._run, func, item) for item in items]
+            return [future.result() for future in futures]
+
+    def close(self):
+        for guest in self.guests:
+            guest.terminate()
+        self.guests = []
+        if self._own_workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
@@ -0,0 +1,165 @@
+import logging
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from qemucommand import QemuCommand
+from testutils import qemu_boot_args, qemu_start, qemu_terminate, guest_session, backoff_delays, \
+    variant_image_dir
+
+logger = logging.getLogger("selftest")
+
+
+class JournalWatcher(object):
+    """
+    Follow the journal of a systemd unit in a guest and wake up whoever
+    waits for a state change each time the unit logs something. Checking
+    the state after every log line, rather than blocking in a command
+    until the state is reached, notices the change as soon as it happens
+    and keeps the guest's log at hand when it does not.
+    """
+
+    def __init__(self, port, unit, tail_lines=200):
+        self.port = port
+        self.unit = unit
+        self.changed = threading.Event()
+        self._tail = deque(maxlen=tail_lines)
+        self._proc = None
+
+    def start(self):
+        self._proc = guest_session(self.port).popen('journalctl --follow --lines=all --output=cat --unit=%s' %
+                                                    self.unit)
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self._proc.stdout:
+            self._tail.append(line.decode(errors='replace').rstrip())
+            self.changed.set()
+
+    def log_tail(self):
+        return '\n'.join(self._tail)
+
+    def wait_until(self, predicate, timeout):
+        """
+        Return the first true result of predicate(), which is called at
+        once, after every new log line and otherwise with exponential
+        backoff, or False if there was none within 'timeout' seconds.
+        """
+        deadline = monotonic() + timeout
+        delays = backoff_delays(timeout, initial=1, maximum=30)
+        while True:
+            self.changed.clear()
+            result = predicate()
+            if result:
+                return result
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return False
+            self.changed.wait(min(next(delays, remaining), remaining))
+
+    def stop(self):
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+
+
+class TopologyGuest(object):
+    """
+    A guest of a GuestTopology, booting the image of an ImageVariant with a
+    second network card on the shared virtual network. 'binary' is the
+    program the image is about; the guest counts as ready once it can run
+    it.
+    """
+
+    def __init__(self, name, variant, binary, **kwargs):
+        self.name = name
+        self.variant = variant
+        self.binary = binary
+        self.kwargs = kwargs
+        self.qemu = None
+        self.process = None
+        self.monitor = None
+        self.ready = False
+        self.error = ''
+
+    def start(self, test):
+        args = qemu_boot_args(self.variant.imagename, machine=self.variant.machine,
+                              dir=variant_image_dir(test, self.variant), secondary_network=True, **self.kwargs)
+        self.qemu = QemuCommand(args)
+        print('Booting %s (%s)...' % (self.name, self.variant.imagename))
+        self.process, self.monitor = qemu_start(self.qemu)
+
+    def wait_ready(self, timeout):
+        if not self.monitor.wait(timeout=timeout):
+            self.error = 'not reachable over ssh. Last console output:\n%s' % self.monitor.console_tail()
+            return False
+        result = self.command(self.binary + ' --help', timeout=60)
+        if not result.ok:
+            self.error = 'running %s failed: %s' % (self.binary, result.stderr.decode(errors='replace'))
+            return False
+        return True
+
+    def command(self, command, timeout=120):
+        return guest_session(self.qemu.ssh_port).run(command, timeout=timeout)
+
+    def watch_journal(self, unit):
+        watcher = JournalWatcher(self.qemu.ssh_port, unit)
+        watcher.start()
+        return watcher
+
+    def terminate(self):
+        if self.process is not None:
+            qemu_terminate(self.process)
+            self.process = None
+
+
+class GuestTopology(object):
+    """
+    Guests connected by the multicast network of 'secondary_network', e.g.
+    an Uptane Primary and any number of IP Secondaries. start() boots them
+    in groups: the guests of a group boot concurrently, and the next group
+    starts once all of the previous one are ready. All images are built
+    before the first guest starts, in the single bitbake call of the
+    ImageMatrix.
+    """
+
+    def __init__(self, test, guests, boot_timeout=300):
+        self.test = test
+        self.guests = list(guests)
+        self.boot_timeout = boot_timeout
+        self._started = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self, *groups):
+        for guest in self.guests:
+            variant_image_dir(self.test, guest.variant)
+        for group in groups:
+            if isinstance(group, TopologyGuest):
+                group = [group]
+            for guest in group:
+                guest.start(self.test)
+                self._started.append(guest)
+            with ThreadPoolExecutor(max_workers=len(group)) as executor:
+                ready = list(executor.map(lambda guest: guest.wait_ready(self.boot_timeout), group))
+            for guest, ok in zip(group, ready):
+                guest.ready = ok
+                if not ok:
+                    self.test.fail('%s failed to boot: %s' % (guest.name, guest.error))
+
+    def stop(self):
+        for guest in reversed(self._started):
+            try:
+                guest.terminate()
+            except subprocess.TimeoutExpired:
+                logger.warning('%s did not stop' % guest.name)
+        self._started = []
+
+
+# vim:set ts=4 sw=4 sts=4 expandtab:
@@ -1,12 +1,25 @@
+import atexit
+import copy
+import fcntl
+import hashlib
+import json
 import os
 import oe.path
 import logging
 import re
+import shlex
+import shutil
+import socket
 import subprocess
-from time import sleep
+import tempfile
+import threading
+import unittest
+from collections import deque, namedtuple
+from time import monotonic, sleep, time
 
-from oeqa.utils.commands import runCmd, bitbake, get_bb_var, get_bb_vars
-from qemucommand import QemuCommand
+from oeqa.utils.commands import runCmd, bitbake
+from oeqa.utils.commands import get_bb_vars as get_bb_env_vars
+from qemucommand import QemuCommand, clone_file
 
 logger = logging.getLogger("selftest")
 
@@ -16,33 +29,46 @@ def qemu_launch(efi=False, machine=None, imagename='core-image-minimal', **kwarg
     return qemu_boot_image(efi=efi, machine=machine, imagename=imagename, **kwargs)
 
 
+def qemu_launch_variant(test, variant, **kwargs):
+    """
+    Boot the image of an ImageVariant, built by the ImageMatrix together
+    with the variants of all other selected tests.
+    """
+    return qemu_boot_image(machine=variant.machine, imagename=variant.imagename,
+                           dir=variant_image_dir(test, variant), **kwargs)
+
+
 def qemu_terminate(s):
+    for port, session in list(_sessions.items()):
+        if session.process is s:
+            session.close()
+            del _sessions[port]
     try:
         s.terminate()
         s.wait(timeout=10)
-    except KeyboardInterrupt:
-        pass
+    except (KeyboardInterrupt, subprocess.TimeoutExpired):
+        s.kill()
+        s.wait()
+    qemu = _running.pop(s, None)
+    if qemu is not None:
+        qemu.release_ports()
+    for workdir in _workdirs.pop(s, []):
+        shutil.rmtree(workdir, ignore_errors=True)
 
 
-def qemu_boot_image(imagename, **kwargs):
+def qemu_boot_args(imagename, **kwargs):
     # Create empty object.
     args = type('', (), {})()
     args.imagename = imagename
     args.mac = kwargs.get('mac', None)
     # Could use DEPLOY_DIR_IMAGE here but it's already in the machine
     # subdirectory.
-    args.dir = 'tmp/deploy/images'
+    args.dir = kwargs.get('dir', 'tmp/deploy/images')
     args.efi = kwargs.get('efi', False)
     args.bootloader = kwargs.get('bootloader', None)
     args.machine = kwargs.get('machine', None)
     args.mem = kwargs.get('mem', '128M')
-    qemu_use_kvm = get_bb_var("QEMU_USE_KVM")
-    if qemu_use_kvm and \
-            (qemu_use_kvm == 'True' and 'x86' in args.machine or
-             get_bb_var('MACHINE') in qemu_use_kvm.split()):
-        args.kvm = True
-    else:
-        args.kvm = None  # Autodetect
+    args.kvm = kwargs.get('kvm', None)  # Autodetect
     args.no_gui = kwargs.get('no_gui', True)
     args.gdb = kwargs.get('gdb', False)
     args.pcap = kwargs.get('pcap', None)
@@ -50,26 +76,634 @@ def qemu_boot_image(imagename, **kwargs):
     args.dry_run = kwargs.get('dry_run', False)
     args.secondary_network = kwargs.get('secondary_network', False)
     args.uboot_enable = kwargs.get('uboot_enable', 'yes')
+    return args
+
+
+def qemu_start(qemu):
+    """
+    Start QEMU for a QemuCommand, creating its overlay first if needed.
+    Returns the process and a started BootMonitor for it.
+    """
+    if qemu.overlay and not os.path.exists(qemu.overlay):
+        subprocess.check_call(qemu.img_command_line(), stdout=subprocess.DEVNULL)
+    s = subprocess.Popen(qemu.command_line())
+    _running[s] = qemu
+    _sessions[qemu.ssh_port] = GuestSession(qemu.ssh_port, process=s)
+    monitor = BootMonitor(qemu, s)
+    monitor.start()
+    return s, monitor
 
+
+def qemu_boot_image(imagename, **kwargs):
+    args = qemu_boot_args(imagename, **kwargs)
+    workdirs = None
+    if kwargs.get('snapshot_cache', False):
+        args, workdirs = BootSnapshotCache().restore_args(args)
     qemu = QemuCommand(args)
-    cmdline = qemu.command_line()
     print('Booting image with run-qemu-ota...')
-    s = subprocess.Popen(cmdline)
-    sleep(kwargs.get('wait_for_boot_time', 10))
+    s, monitor = qemu_start(qemu)
+    if workdirs is not None:
+        _workdirs[s] = workdirs
+        BootSnapshotCache.resume(args.monitor)
+    if not monitor.wait(timeout=kwargs.get('wait_for_boot_time', 300)):
+        logger.warning('Guest did not become reachable over ssh. Last console output:\n%s' % monitor.console_tail())
+    elif workdirs is not None:
+        # The guest clock stopped when the snapshot was taken.
+        qemu_send_command(qemu.ssh_port, 'date -s @%d' % time())
     return qemu, s
 
 
+class HumanMonitor(object):
+    """
+    Minimal client for the QEMU human monitor listening on a unix socket.
+    """
+
+    PROMPT = b'(qemu) '
+
+    def __init__(self, path, timeout=30):
+        deadline = monotonic() + timeout
+        while True:
+            self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.conn.connect(path)
+                break
+            except OSError:
+                self.conn.close()
+                if monotonic() > deadline:
+                    raise
+                sleep(0.05)
+        self.conn.settimeout(timeout)
+        self._read()
+
+    def _read(self):
+        data = b''
+        while not data.endswith(self.PROMPT):
+            chunk = self.conn.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return data.decode(errors='replace')
+
+    def command(self, command):
+        self.conn.sendall(command.encode() + b'\n')
+        return self._read()
+
+    def close(self):
+        self.conn.close()
+
+
+class BootSnapshotCache(object):
+    """
+    Snapshots of booted guests, so that tests do not have to go through
+    U-Boot, the kernel and systemd every time. The first boot of an image
+    waits until the guest serves ssh, then stops it and saves its RAM and
+    device state to a file. Its disk state stays in the qcow2 overlay it
+    ran on. Later boots run on a new overlay backed by that disk and
+    resume from the saved state.
+
+    Snapshots are keyed by the deployed image, identified by its path,
+    inode, size and modification time, and by the QEMU settings that end
+    up in the saved state. When bitbake deploys a new image, the snapshots
+    of the old one are removed the next time one is needed.
+    """
+
+    def __init__(self, cache_dir='tmp/qemu-snapshots'):
+        self.cache_dir = os.path.abspath(cache_dir)
+
+    def key(self, args):
+        plain = copy.copy(args)
+        plain.overlay = None
+        probe = QemuCommand(plain)
+        probe.release_ports()
+        st = os.stat(probe.image)
+        h = hashlib.sha256()
+        for value in [probe.image, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                      getattr(probe, 'bios', None), probe.kernel, probe.machine, probe.mem, probe.kvm,
+                      probe.drive_interface, probe.secondary_network]:
+            h.update(repr(value).encode() + b'\0')
+        return h.hexdigest()[:16], probe.image
+
+    def prune(self, image, keep):
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name, 'info.json')
+            if name == keep or not os.path.exists(path):
+                continue
+            with open(path) as f:
+                if json.load(f)['image'] == image:
+                    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def create(self, args, entry, image, timeout=300):
+        golden = copy.copy(args)
+        golden.overlay = os.path.join(entry, 'disk.cow')
+        # Unix socket paths are short, stay out of the build directory.
+        sockdir = tempfile.mkdtemp(prefix='ota-hmp-')
+        golden.monitor = os.path.join(sockdir, 'monitor')
+        qemu = QemuCommand(golden)
+        print('Booting %s to take a boot snapshot...' % image)
+        s, monitor = qemu_start(qemu)
+        state = os.path.join(entry, 'state')
+        try:
+            if not monitor.wait(timeout=timeout):
+                raise RuntimeError('Guest did not boot, no snapshot taken. Last console output:\n%s' %
+                                   monitor.console_tail())
+            # The ssh connection would not survive the restore.
+            guest_session(qemu.ssh_port).disconnect()
+            hmp = HumanMonitor(golden.monitor)
+            hmp.command('stop')
+            hmp.command('migrate "exec:cat > %s"' % shlex.quote(state + '.tmp'))
+            for delay in backoff_delays(timeout, maximum=1):
+                status = hmp.command('info migrate')
+                if 'Migration status: completed' in status:
+                    break
+                if 'Migration status: failed' in status:
+                    raise RuntimeError('Saving the boot snapshot failed:\n%s' % status)
+                sleep(delay)
+            else:
+                raise RuntimeError('Saving the boot snapshot timed out')
+            hmp.command('quit')
+            hmp.close()
+            s.wait(timeout=60)
+        finally:
+            qemu_terminate(s)
+            shutil.rmtree(sockdir, ignore_errors=True)
+        os.replace(state + '.tmp', state)
+        with open(os.path.join(entry, 'info.json'), 'w') as f:
+            json.dump({'image': image, 'mac': qemu.mac_address}, f)
+
+    def restore_args(self, args):
+        """
+        Return boot arguments resuming from the snapshot of the image
+        'args' would boot, taking the snapshot first if there is none, and
+        the directories holding the overlay and the monitor socket of the
+        new guest. The caller removes them once the guest is stopped and
+        calls resume() once it is started.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        key, image = self.key(args)
+        entry = os.path.join(self.cache_dir, key)
+        with open(entry + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(os.path.join(entry, 'info.json')):
+                self.prune(image, key)
+                shutil.rmtree(entry, ignore_errors=True)
+                os.makedirs(entry)
+                self.create(args, entry, image)
+
+        with open(os.path.join(entry, 'info.json')) as f:
+            info = json.load(f)
+        workdir = tempfile.mkdtemp(prefix='run-', dir=self.cache_dir)
+        overlay = os.path.join(workdir, 'disk.cow')
+        subprocess.check_call(['qemu-img', 'create', '-f', 'qcow2', '-b', os.path.join(entry, 'disk.cow'),
+                               '-F', 'qcow2', overlay], stdout=subprocess.DEVNULL)
+        # QemuCommand expects the files it makes for a new overlay. They are
+        # only read, so they can share the data of the snapshot's.
+        for suffix in ['.img', '.u-boot.rom']:
+            if os.path.exists(os.path.join(entry, 'disk.cow' + suffix)):
+                clone_file(os.path.join(entry, 'disk.cow' + suffix), overlay + suffix)
+        restored = copy.copy(args)
+        restored.overlay = overlay
+        # The saved network card has to keep its address.
+        restored.mac = info['mac']
+        restored.incoming = 'exec:cat %s' % shlex.quote(os.path.join(entry, 'state'))
+        sockdir = tempfile.mkdtemp(prefix='ota-hmp-')
+        restored.monitor = os.path.join(sockdir, 'monitor')
+        return restored, [workdir, sockdir]
+
+    @staticmethod
+    def resume(monitor_path, timeout=120):
+        """
+        Continue a guest started from restore_args() once it has loaded the
+        saved state. The guest was stopped when the snapshot was taken, and
+        QEMU restores it in that state.
+        """
+        hmp = HumanMonitor(monitor_path)
+        try:
+            for delay in backoff_delays(timeout, maximum=1):
+                status = hmp.command('info status')
+                if 'inmigrate' not in status:
+                    break
+                sleep(delay)
+            else:
+                raise RuntimeError('Loading the boot snapshot timed out')
+            if 'running' not in status:
+                hmp.command('cont')
+        finally:
+            hmp.close()
+
+
+def backoff_delays(total, initial=0.25, factor=2, maximum=10):
+    """
+    Yield exponentially growing delays that add up to at most 'total'
+    seconds. Used by polling loops to react fast to a guest that is almost
+    ready without hammering one that is still booting.
+    """
+    delay = initial
+    remaining = total
+    while remaining > 0:
+        delay = min(delay, maximum, remaining)
+        yield delay
+        remaining -= delay
+        delay *= factor
+
+
+def ssh_banner_received(port, timeout=1):
+    """
+    Check whether an ssh server answers on a forwarded port. QEMU user
+    networking accepts the connection on the host side even when nothing
+    listens in the guest, so wait for the server's identification string.
+    """
+    try:
+        with socket.create_connection(('localhost', port), timeout=timeout) as conn:
+            return conn.recv(256).startswith(b'SSH-')
+    except (OSError, socket.timeout):
+        return False
+
+
+class BootMonitor(object):
+    """
+    Follow the boot of a QEMU guest. The serial console is read in a
+    background thread, both to detect the login prompt and to keep the last
+    lines for diagnostics, while the forwarded ssh port is probed with
+    exponential backoff. wait() returns as soon as the guest accepts ssh
+    connections.
+    """
+
+    def __init__(self, qemu, process, marker=b'login:', tail_lines=50):
+        self.qemu = qemu
+        self.process = process
+        self.marker = marker
+        self.booted = threading.Event()
+        self._tail = deque(maxlen=tail_lines)
+        self._thread = threading.Thread(target=self._read_console, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _connect_console(self):
+        # QEMU only starts listening on the serial port once it runs.
+        for delay in backoff_delays(30, initial=0.05, maximum=1):
+            if self.process.poll() is not None:
+                return None
+            try:
+                return socket.create_connection(('localhost', self.qemu.serial_port), timeout=1)
+            except OSError:
+                sleep(delay)
+        return None
+
+    def _read_console(self):
+        conn = self._connect_console()
+        if conn is None:
+            return
+        conn.settimeout(None)
+        pending = b''
+        with conn:
+            while True:
+                try:
+                    data = conn.recv(4096)
+                except OSError:
+                    break
+                if not data:
+                    break
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()
+                self._tail.extend(lines)
+                if self.marker in data or self.marker in pending:
+                    self.booted.set()
+
+    def console_tail(self):
+        return b'\n'.join(self._tail).decode(errors='replace')
+
+    def wait(self, timeout=300):
+        """
+        Wait until the guest serves ssh, at most 'timeout' seconds. Returns
+        False if it did not, or if QEMU exited in the meantime.
+        """
+        deadline = monotonic() + timeout
+        delays = backoff_delays(timeout, initial=0.1, maximum=2)
+        while True:
+            if self.process.poll() is not None:
+                return False
+            if ssh_banner_received(self.qemu.ssh_port):
+                return True
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return False
+            # Once the login prompt is there, sshd is about to come up.
+            delay = 0.1 if self.booted.is_set() else next(delays, remaining)
+            sleep(min(delay, remaining))
+
+
+class ImageVariant(object):
+    """
+    An image built with additional configuration lines. Test classes that
+    only differ in a few settings declare their image as a class attribute
+    'image_variant' (or their images as 'image_variants') instead of
+    calling append_config() and bitbake in setUpLocal(), so that the
+    ImageMatrix can build all of them at once.
+    """
+
+    def __init__(self, config, imagename='core-image-minimal', machine='qemux86-64', layers=(), name=None):
+        self.config = list(config)
+        self.imagename = imagename
+        self.machine = machine
+        self.layers = list(layers)
+        # Variants whose configuration changes from run to run should have
+        # a name, so that they keep building in the same TMPDIR.
+        self.name = name
+
+    @property
+    def key(self):
+        h = hashlib.sha256()
+        for value in [self.imagename, self.machine] + self.layers + self.config:
+            h.update(value.encode() + b'\0')
+        return h.hexdigest()[:12]
+
+    @property
+    def multiconfig(self):
+        return 'selftest-%s' % (self.name or self.key)
+
+    @property
+    def deploy_dir(self):
+        # Relative to the build directory, like the default of run-qemu-ota.
+        return 'tmp-%s/deploy/images' % self.multiconfig
+
+    def multiconfig_data(self):
+        lines = ['MACHINE = "%s"' % self.machine,
+                 'TMPDIR = "${TOPDIR}/tmp-%s"' % self.multiconfig]
+        return '\n'.join(lines + self.config) + '\n'
+
+
+class ImageMatrix(object):
+    """
+    Build the images of all selected tests that declare an ImageVariant.
+    The first test that needs its image triggers a single bitbake call
+    building every distinct variant of the run as a multiconfig, so they
+    build in parallel. Later tests get the image that is already there
+    without running bitbake again.
+    """
+
+    def __init__(self):
+        self.built = set()
+        self.files = []
+
+    def selected_variants(self, test):
+        variants = []
+
+        def walk(suite):
+            for item in suite:
+                if isinstance(item, unittest.TestSuite):
+                    walk(item)
+                else:
+                    cls = type(item)
+                    if getattr(cls, 'image_variant', None) is not None:
+                        variants.append(cls.image_variant)
+                    variants.extend(getattr(cls, 'image_variants', []))
+
+        tc = getattr(test, 'tc', None)
+        walk(getattr(tc, 'suites', None) or [])
+        return variants
+
+    def image_dir(self, test, variant):
+        """
+        Return the deploy directory holding the image of 'variant', building
+        it first if it has not been built in this run.
+        """
+        if variant.key not in self.built:
+            pending = {}
+            for v in [variant] + self.selected_variants(test):
+                if v.key not in self.built:
+                    pending.setdefault(v.key, v)
+            self.build(test, list(pending.values()), variant)
+        return variant.deploy_dir
+
+    def build(self, test, variants, needed):
+        require_layers(*sorted(set(layer for v in variants for layer in v.layers)))
+        confdir = os.path.join(os.environ.get('BUILDDIR', os.getcwd()), 'conf', 'multiconfig')
+        os.makedirs(confdir, exist_ok=True)
+        for v in variants:
+            path = os.path.join(confdir, '%s.conf' % v.multiconfig)
+            with open(path, 'w') as f:
+                f.write(v.multiconfig_data())
+            if not self.files:
+                atexit.register(self.cleanup)
+            if path not in self.files:
+                self.files.append(path)
+
+        line = 'BBMULTICONFIG += "%s"' % ' '.join(v.multiconfig for v in variants)
+        test.append_config(line)
+        try:
+            logger.info('Running bitbake to build %d image variants' % len(variants))
+            result = bitbake('-k ' + ' '.join('mc:%s:%s' % (v.multiconfig, v.imagename) for v in variants),
+                             ignore_status=True)
+        finally:
+            test.remove_config(line)
+        if result.status == 0:
+            self.built.update(v.key for v in variants)
+        elif len(variants) > 1:
+            # Some variant failed. Build the one needed now on its own, to
+            # get its own result; the others are retried when needed.
+            self.build(test, [needed], needed)
+        else:
+            test.fail('Building %s failed:\n%s' % (needed.multiconfig, result.output))
+
+    def cleanup(self):
+        for path in self.files:
+            if os.path.exists(path):
+                os.remove(path)
+        self.files = []
+
+
+_matrix = ImageMatrix()
+
+
+def variant_image_dir(test, variant):
+    return _matrix.image_dir(test, variant)
+
+
 def qemu_bake_image(imagename):
     logger.info('Running bitbake to build {}'.format(imagename))
     bitbake(imagename)
 
 
+SSH_OPTIONS = ['-q', '-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no',
+               '-o', 'ConnectTimeout=10', '-o', 'ServerAliveInterval=5', '-o', 'ServerAliveCountMax=3']
+
+
+class CommandResult(namedtuple('CommandResult', ['stdout', 'stderr', 'returncode'])):
+    """
+    Result of a command run in the guest. Unpacks like the (stdout, stderr,
+    returncode) tuple qemu_send_command always returned, and additionally
+    records how long the command took.
+    """
+
+    def __new__(cls, stdout, stderr, returncode, duration=0.0):
+        self = super().__new__(cls, stdout, stderr, returncode)
+        self.duration = duration
+        return self
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+
+class GuestSession(object):
+    """
+    One multiplexed ssh connection to a guest. A master connection is kept
+    open in the background (ssh ControlMaster) and every command runs as a
+    new channel on it, so only the first command pays for the TCP
+    connection and the key exchange. If the master cannot be established,
+    for instance because the guest is still booting, commands fall back to
+    a connection of their own.
+    """
+
+    def __init__(self, port, user='root', host='localhost', process=None):
+        self.port = port
+        self.destination = '%s@%s' % (user, host)
+        self.process = process
+        self._dir = None
+        self._master = None
+
+    @property
+    def control_path(self):
+        if self._dir is None:
+            # Unix socket paths are short, stay out of the build directory.
+            self._dir = tempfile.mkdtemp(prefix='ota-ssh-')
+        return os.path.join(self._dir, 'master')
+
+    def _connect(self, timeout=30):
+        if self._master is not None and self._master.poll() is None:
+            return os.path.exists(self.control_path)
+        self._master = subprocess.Popen(['ssh'] + SSH_OPTIONS +
+                                        ['-M', '-N', '-S', self.control_path, '-p', str(self.port), self.destination],
+                                        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        deadline = monotonic() + timeout
+        while monotonic() < deadline and self._master.poll() is None:
+            if os.path.exists(self.control_path):
+                return True
+            sleep(0.02)
+        return False
+
+    def _command_line(self, command):
+        cmd = ['ssh'] + SSH_OPTIONS
+        if self._connect():
+            cmd += ['-S', self.control_path, '-o', 'ControlMaster=no']
+        return cmd + ['-p', str(self.port), self.destination, command]
+
+    def popen(self, command):
+        """
+        Start a long running 'command', e.g. one following a log, and return
+        the local ssh process with the command's output on its stdout.
+        """
+        return subprocess.Popen(self._command_line(command), stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def run(self, command, timeout=120):
+        """
+        Run 'command' through the guest's shell. Raises
+        subprocess.TimeoutExpired if it does not finish within 'timeout'
+        seconds.
+        """
+        start = monotonic()
+        proc = subprocess.Popen(self._command_line(command), stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
+        if proc.returncode == 255:
+            # The connection failed. The guest may have rebooted, so start
+            # over with a new master next time.
+            self.disconnect()
+        return CommandResult(stdout, stderr, proc.returncode, monotonic() - start)
+
+    def disconnect(self):
+        if self._master is not None:
+            if self._master.poll() is None:
+                self._master.terminate()
+                try:
+                    self._master.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self._master.kill()
+                    self._master.wait()
+            self._master = None
+
+    def close(self):
+        self.disconnect()
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+
+# Sessions of the running guests, by forwarded ssh port.
+_sessions = {}
+# QemuCommand of the running guests, by QEMU process.
+_running = {}
+# Lists of directories to remove once a guest is stopped, by QEMU process.
+_workdirs = {}
+
+
+def guest_session(port):
+    session = _sessions.get(port)
+    if session is None:
+        session = _sessions[port] = GuestSession(port)
+    return session
+
+
 def qemu_send_command(port, command, timeout=120):
-    command = ['ssh -q -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no root@localhost -p ' +
-               str(port) + ' "' + command + '"']
-    s2 = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = s2.communicate(timeout=timeout)
-    return stdout, stderr, s2.returncode
+    return guest_session(port).run(command, timeout=timeout)
+
+
+# Environment of each bitbake target, for the configuration in _bb_env_hash.
+_bb_env_cache = {}
+_bb_env_hash = None
+
+
+def config_hash():
+    """
+    Hash the files of the build configuration. append_config() and
+    bitbake-layers write them, so any change of the configuration changes
+    the hash.
+    """
+    confdir = os.path.join(os.environ.get('BUILDDIR', os.getcwd()), 'conf')
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(confdir)):
+        path = os.path.join(confdir, name)
+        if os.path.isfile(path):
+            h.update(name.encode() + b'\0')
+            with open(path, 'rb') as f:
+                h.update(f.read())
+            h.update(b'\0')
+    return h.hexdigest()
+
+
+def get_bb_vars(variables=None, target=None, postconfig=None):
+    """
+    Same as oeqa.utils.commands.get_bb_vars(), but every 'bitbake -e' is
+    run only once per target and configuration: the whole environment is
+    kept, so later lookups of any variable of the same target are free.
+    The cache is dropped as soon as the build configuration changes.
+    Lookups with 'postconfig' are not cached.
+    """
+    global _bb_env_hash
+    if postconfig is not None:
+        return get_bb_env_vars(variables, target, postconfig)
+    current = config_hash()
+    if current != _bb_env_hash:
+        _bb_env_cache.clear()
+        _bb_env_hash = current
+    values = _bb_env_cache.get(target)
+    if values is None:
+        values = _bb_env_cache[target] = get_bb_env_vars(None, target)
+    if variables is None:
+        return dict(values)
+    return {var: values.get(var) for var in variables}
+
+
+def get_bb_var(variable, target=None, postconfig=None):
+    return get_bb_vars([variable], target, postconfig)[variable]
 
 
 def metadir():
@@ -82,6 +716,58 @@ def metadir():
     return metadir
 
 
+class LayerFixture(object):
+    """
+    Layers the test classes need on top of the build configuration. Each
+    class asks for its layers in setUpLocal(). The layers of the build are
+    read only once, missing layers are added in a single bitbake-layers
+    call, and every added layer stays until the end of the test run, when
+    all of them are removed again in a single call. This spares the
+    show-layers, add-layer and remove-layer calls that every class used to
+    make, each of which reparses the layer configuration.
+    """
+
+    def __init__(self):
+        self.present = None
+        self.added = []
+
+    def require(self, *names):
+        if self.present is None:
+            result = runCmd('bitbake-layers show-layers')
+            self.present = set()
+            for line in result.output.splitlines():
+                fields = line.split()
+                if len(fields) >= 2 and os.path.isabs(fields[1]):
+                    self.present.add(os.path.basename(os.path.normpath(fields[1])))
+        missing = [name for name in names if name not in self.present]
+        if not missing:
+            return
+        paths = [metadir() + name for name in missing]
+        runCmd('bitbake-layers add-layer %s' % ' '.join('"%s"' % path for path in paths))
+        if not self.added:
+            atexit.register(self.restore)
+        self.present.update(missing)
+        self.added.extend(paths)
+
+    def restore(self):
+        if self.added:
+            runCmd('bitbake-layers remove-layer %s' % ' '.join('"%s"' % path for path in reversed(self.added)),
+                   ignore_status=True)
+            self.present.difference_update(os.path.basename(path) for path in self.added)
+            self.added = []
+
+
+_layers = LayerFixture()
+
+
+def require_layers(*names):
+    """
+    Make sure the layers named 'names', found next to meta-updater, are in
+    the build until the end of the test run.
+    """
+    _layers.require(*names)
+
+
 def akt_native_run(testInst, cmd, **kwargs):
     # run a command supplied by aktualizr-native and checks that:
     # - the executable exists
@@ -102,7 +788,7 @@ def akt_native_run(testInst, cmd, **kwargs):
 def verifyNotProvisioned(testInst, machine):
     print('Checking output of aktualizr-info:')
     ran_ok = False
-    for delay in [5, 5, 5, 5, 10, 10, 10, 10]:
+    for delay in backoff_delays(60):
         stdout, stderr, retcode = testInst.qemu_command('aktualizr-info')
         if retcode == 0 and stderr == b'':
             ran_ok = True
@@ -125,7 +811,7 @@ def verifyProvisioned(testInst, machine, hwid=''):
     # Verify that device HAS provisioned.
     # First loop while waiting for the device to boot.
     ran_ok = False
-    for delay in [5, 5, 5, 5, 10, 10, 10, 10]:
+    for delay in backoff_delays(60):
         stdout, stderr, retcode = testInst.qemu_command('aktualizr-info')
         if retcode == 0 and stderr == b'':
             ran_ok = True
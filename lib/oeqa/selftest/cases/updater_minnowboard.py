@@ -1,26 +1,12 @@
-import re
-
 from oeqa.selftest.case import OESelftestTestCase
-from oeqa.utils.commands import runCmd, get_bb_var
-from testutils import metadir, qemu_launch, qemu_send_command, qemu_terminate, verifyProvisioned
+from testutils import require_layers, qemu_launch, qemu_send_command, qemu_terminate, verifyProvisioned, \
+    get_bb_var
 
 
 class MinnowTests(OESelftestTestCase):
 
     def setUpLocal(self):
-        layer_intel = "meta-intel"
-        layer_minnow = "meta-updater-minnowboard"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer_intel, result.output) is None:
-            self.meta_intel = metadir() + layer_intel
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_intel)
-        else:
-            self.meta_intel = None
-        if re.search(layer_minnow, result.output) is None:
-            self.meta_minnow = metadir() + layer_minnow
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_minnow)
-        else:
-            self.meta_minnow = None
+        require_layers('meta-intel', 'meta-updater-minnowboard')
         self.append_config('MACHINE = "intel-corei7-64"')
         self.append_config('OSTREE_BOOTLOADER = "grub"')
         self.append_config('SOTA_CLIENT_PROV = " aktualizr-shared-prov "')
@@ -28,10 +14,6 @@ class MinnowTests(OESelftestTestCase):
 
     def tearDownLocal(self):
         qemu_terminate(self.s)
-        if self.meta_intel:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_intel, ignore_status=True)
-        if self.meta_minnow:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_minnow, ignore_status=True)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -2,8 +2,8 @@
 import logging
 
 from oeqa.selftest.case import OESelftestTestCase
-from oeqa.utils.commands import runCmd, bitbake, get_bb_var
-from testutils import akt_native_run
+from oeqa.utils.commands import runCmd, bitbake
+from testutils import akt_native_run, get_bb_var
 
 
 class SotaToolsTests(OESelftestTestCase):
@@ -8,10 +8,12 @@ from time import sleep
 from uuid import uuid4
 
 from oeqa.selftest.case import OESelftestTestCase
-from oeqa.utils.commands import runCmd, bitbake, get_bb_var, get_bb_vars
+from oeqa.utils.commands import runCmd, bitbake
 from testutils import qemu_launch, qemu_send_command, qemu_terminate, \
-    metadir, akt_native_run, verifyNotProvisioned, verifyProvisioned, \
-    qemu_bake_image, qemu_boot_image
+    require_layers, akt_native_run, verifyNotProvisioned, verifyProvisioned, \
+    backoff_delays, get_bb_var, get_bb_vars, \
+    ImageVariant, qemu_launch_variant
+from qemutopology import GuestTopology, TopologyGuest
 
 
 class GeneralTests(OESelftestTestCase):
@@ -36,6 +38,58 @@ class GeneralTests(OESelftestTestCase):
                         (deploydir, imagename), ignore_status=True)
         self.assertEqual(result.status, 0, "Status not equal to 0. output: %s" % result.output)
 
+    def test_ostree_deltas_and_retention(self):
+        logger = logging.getLogger("selftest")
+        logger.info('Running bitbake to build ostree-native')
+        self.append_config('SOTA_CLIENT_PROV = "aktualizr-shared-prov"')
+        self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
+        bitbake('ostree-native')
+        bitbake('build-sysroots -c build_native_sysroot')
+        bb_vars = get_bb_vars(['STAGING_DIR', 'BUILD_ARCH'])
+        sysroot = os.path.join(bb_vars['STAGING_DIR'], bb_vars['BUILD_ARCH'])
+
+        # Every build changes os-release, so that it makes a new commit.
+        run_id = uuid4().hex[:8]
+        commits = []
+
+        def build():
+            self.append_config('DISTRO_VERSION:forcevariable = "%s-%d"' % (run_id, len(commits)))
+            logger.info('Running bitbake to build core-image-minimal, commit %d' % len(commits))
+            bitbake('core-image-minimal')
+            bb_vars = get_bb_vars(['WORKDIR', 'OSTREE_REPO', 'OSTREE_BRANCHNAME'], 'core-image-minimal')
+            with open(os.path.join(bb_vars['WORKDIR'], 'ostree_manifest')) as f:
+                commits.append(f.read().strip())
+            return bb_vars
+
+        # Only the last commit is kept, so the branch history is cut off.
+        self.append_config('OSTREE_REPO_RETAIN_COMMITS = "1"')
+        build()
+        build()
+        # The first delta history walk runs into the pruned commit and has
+        # to stop there. The last build prunes the commit the deltas of the
+        # third build start from.
+        self.append_config('BUILD_OSTREE_DELTAS = "1"')
+        self.append_config('OSTREE_DELTA_DEPTH = "2"')
+        self.append_config('OSTREE_REPO_RETAIN_COMMITS = "3"')
+        build()
+        build()
+        bb_vars = build()
+
+        ostree = 'ostree --repo=%s ' % bb_vars['OSTREE_REPO']
+        result = runCmd(ostree + 'log ' + bb_vars['OSTREE_BRANCHNAME'], native_sysroot=sysroot)
+        for commit in commits[2:]:
+            self.assertIn(commit, result.output, 'Commit %s was pruned' % commit)
+        for commit in commits[:2]:
+            self.assertNotIn(commit, result.output, 'Commit %s was not pruned' % commit)
+
+        result = runCmd(ostree + 'static-delta list', native_sysroot=sysroot)
+        deltas = result.output.split()
+        for delta in [commits[4], '%s-%s' % (commits[3], commits[4]), '%s-%s' % (commits[2], commits[4])]:
+            self.assertIn(delta, deltas, 'Static delta %s is missing' % delta)
+        for commit in commits[:2]:
+            self.assertFalse([delta for delta in deltas if commit in delta],
+                             'Static deltas of the pruned commit %s were kept: %s' % (commit, result.output))
+
 
 class AktualizrToolsTests(OESelftestTestCase):
 
@@ -75,13 +129,7 @@ class AktualizrToolsTests(OESelftestTestCase):
 class SharedCredProvTests(OESelftestTestCase):
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        require_layers('meta-updater-qemux86-64')
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SOTA_CLIENT_PROV = " aktualizr-shared-prov "')
         self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
@@ -90,8 +138,6 @@ class SharedCredProvTests(OESelftestTestCase):
 
     def tearDownLocal(self):
         qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -115,13 +161,7 @@ class SharedCredProvTests(OESelftestTestCase):
 class SharedCredProvTestsNonOSTree(SharedCredProvTests):
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        require_layers('meta-updater-qemux86-64')
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SOTA_CLIENT_PROV = ""')
         self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
@@ -138,25 +178,19 @@ class SharedCredProvTestsNonOSTree(SharedCredProvTests):
 
 
 class ManualControlTests(OESelftestTestCase):
+    image_variant = ImageVariant([
+        'SOTA_CLIENT_PROV = " aktualizr-shared-prov "',
+        'SYSTEMD_AUTO_ENABLE:aktualizr = "disable"',
+        'IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"',
+    ], layers=['meta-updater-qemux86-64'])
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
-        self.append_config('MACHINE = "qemux86-64"')
-        self.append_config('SOTA_CLIENT_PROV = " aktualizr-shared-prov "')
-        self.append_config('SYSTEMD_AUTO_ENABLE:aktualizr = "disable"')
-        self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
-        self.qemu, self.s = qemu_launch(machine='qemux86-64')
+        # aktualizr does not run on its own here, so nothing in the guest
+        # minds being resumed from a boot snapshot.
+        self.qemu, self.s = qemu_launch_variant(self, self.image_variant, snapshot_cache=True)
 
     def tearDownLocal(self):
         qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -165,7 +199,9 @@ class ManualControlTests(OESelftestTestCase):
         """
         Disable the systemd service then run aktualizr manually
         """
-        sleep(20)
+        # Let the boot finish, so that aktualizr would have had its chance
+        # to start. The state may be "degraded", which does not matter here.
+        self.qemu_command('systemctl is-system-running --wait')
         stdout, stderr, retcode = self.qemu_command('aktualizr-info')
         self.assertIn(b'Can\'t open database', stderr,
                       'Aktualizr should not have run yet' + stderr.decode() + stdout.decode())
@@ -180,13 +216,7 @@ class ManualControlTests(OESelftestTestCase):
 class DeviceCredProvTests(OESelftestTestCase):
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        require_layers('meta-updater-qemux86-64')
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SOTA_CLIENT_PROV = " aktualizr-device-prov "')
         self.append_config('SOTA_DEPLOY_CREDENTIALS = "0"')
@@ -196,8 +226,6 @@ class DeviceCredProvTests(OESelftestTestCase):
 
     def tearDownLocal(self):
         qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -232,13 +260,7 @@ class DeviceCredProvTests(OESelftestTestCase):
 class DeviceCredProvHsmTests(OESelftestTestCase):
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        require_layers('meta-updater-qemux86-64')
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SOTA_CLIENT_PROV = "aktualizr-device-prov-hsm"')
         self.append_config('SOTA_DEPLOY_CREDENTIALS = "0"')
@@ -250,8 +272,6 @@ class DeviceCredProvHsmTests(OESelftestTestCase):
 
     def tearDownLocal(self):
         qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -290,7 +310,7 @@ class DeviceCredProvHsmTests(OESelftestTestCase):
                        .format(creds=creds, port=self.qemu.ssh_port, config=config))
 
         # Verify that HSM is able to initialize.
-        for delay in [5, 5, 5, 5, 10]:
+        for delay in backoff_delays(30):
             sleep(delay)
             p11_out, p11_err, p11_ret = self.qemu_command(pkcs11_command)
             hsm_out, hsm_err, hsm_ret = self.qemu_command(softhsm2_command)
@@ -323,145 +343,103 @@ class DeviceCredProvHsmTests(OESelftestTestCase):
         verifyProvisioned(self, machine)
 
 
-class IpSecondaryTests(OESelftestTestCase):
+def ip_secondary_variants(count, hwid='qemux86-64-oeselftest-sndry'):
+    """
+    Image variants of a Primary with 'count' IP Secondaries on the virtual
+    network, the Secondaries at consecutive addresses after the Primary's.
+    The serials are new for every run, like the devices the Primary
+    registers with the server. Returns the variants and the
+    (hardware ID, serial) of each Secondary.
+    """
+    secondaries = []
+    ids = []
+    ips = []
+    for index in range(count):
+        serial = str(uuid4())
+        ip = '192.168.254.%d' % (2 + index)
+        secondaries.append(ImageVariant([
+            'IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"',
+            'SECONDARY_SERIAL_ID = "%s"' % serial,
+            'SECONDARY_HARDWARE_ID = "%s"' % hwid,
+            'SECONDARY_IP = "%s"' % ip,
+        ], imagename='secondary-image', layers=['meta-updater-qemux86-64'], name='ip-secondary-%d' % index))
+        ids.append((hwid, serial))
+        ips.append(ip)
+    primary = ImageVariant([
+        'SOTA_CLIENT_PROV = " aktualizr-shared-prov "',
+        'IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"',
+        'PRIMARY_SECONDARIES = "%s"' % ' '.join('%s:9050' % ip for ip in ips),
+    ], imagename='primary-image', layers=['meta-updater-qemux86-64'], name='ip-primary-%d' % count)
+    return primary, secondaries, ids
 
-    class Image:
-        def __init__(self, imagename, binaryname, machine='qemux86-64', bake=True, **kwargs):
-            self.machine = machine
-            self.imagename = imagename
-            self.boot_kwargs = kwargs
-            self.binaryname = binaryname
-            self.stdout = ''
-            self.stderr = ''
-            self.retcode = 0
-            if bake:
-                self.bake()
-
-        def bake(self):
-            self.configure()
-            qemu_bake_image(self.imagename)
-
-        def send_command(self, cmd, timeout=60):
-            stdout, stderr, retcode = qemu_send_command(self.qemu.ssh_port, cmd, timeout=timeout)
-            return str(stdout), str(stderr), retcode
-
-        def __enter__(self):
-            self.qemu, self.process = qemu_boot_image(machine=self.machine, imagename=self.imagename,
-                                                      wait_for_boot_time=1, **self.boot_kwargs)
-            # wait until the VM is booted and is SSHable
-            self.wait_till_sshable()
-
-        def __exit__(self, exc_type, exc_val, exc_tb):
-            qemu_terminate(self.process)
-
-        def wait_till_sshable(self):
-            # qemu_send_command tries to ssh into the qemu VM and blocks until it gets there or timeout happens
-            # so it helps us to block q control flow until the VM is booted and a target binary/daemon is running there
-            self.stdout, self.stderr, self.retcode = self.send_command(self.binaryname + ' --help', timeout=300)
-
-        def was_successfully_booted(self):
-            return self.retcode == 0
-
-    class Secondary(Image):
-        def __init__(self, test_ctx):
-            self._test_ctx = test_ctx
-            self.sndry_serial = str(uuid4())
-            self.sndry_hw_id = 'qemux86-64-oeselftest-sndry'
-            self.id = (self.sndry_hw_id, self.sndry_serial)
-            super(IpSecondaryTests.Secondary, self).__init__('secondary-image', 'aktualizr-secondary',
-                                                             secondary_network=True)
-
-        def configure(self):
-            self._test_ctx.append_config('SECONDARY_SERIAL_ID = "{}"'.format(self.sndry_serial))
-            self._test_ctx.append_config('SECONDARY_HARDWARE_ID = "{}"'.format(self.sndry_hw_id))
-
-    class Primary(Image):
-        def __init__(self, test_ctx):
-            self._test_ctx = test_ctx
-            super(IpSecondaryTests.Primary, self).__init__('primary-image', 'aktualizr', secondary_network=True)
-
-        def configure(self):
-            self._test_ctx.append_config('MACHINE = "qemux86-64"')
-            self._test_ctx.append_config('SOTA_CLIENT_PROV = " aktualizr-shared-prov "')
-
-        def is_ecu_registered(self, ecu_id):
-            device_status = self.get_info()
-
-            if not ((device_status.find(ecu_id[0]) != -1) and (device_status.find(ecu_id[1]) != -1)):
-                return False
-            not_registered_field = "Removed or not registered ecus:"
-            not_reg_start = device_status.find(not_registered_field)
-            return not_reg_start == -1 or (device_status.find(ecu_id[1], not_reg_start) == -1)
-
-        def get_info(self):
-            stdout, stderr, retcode = self.send_command('aktualizr-info --wait-until-provisioned', timeout=620)
-            self._test_ctx.assertEqual(retcode, 0, 'Unable to run aktualizr-info: {}'.format(stderr))
-            return stdout
 
-    def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+class IpSecondaryTests(OESelftestTestCase):
+    primary_variant, secondary_variants, secondary_ids = ip_secondary_variants(1)
+    image_variants = [primary_variant] + secondary_variants
 
-        self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
-        self.primary = IpSecondaryTests.Primary(self)
-        self.secondary = IpSecondaryTests.Secondary(self)
+    def setUpLocal(self):
+        self.primary = TopologyGuest('The primary', self.primary_variant, 'aktualizr')
+        self.secondaries = [TopologyGuest('Secondary %d' % index, variant, 'aktualizr-secondary')
+                            for index, variant in enumerate(self.secondary_variants)]
+        self.topology = GuestTopology(self, [self.primary] + self.secondaries)
 
     def tearDownLocal(self):
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
+        self.topology.stop()
 
-    def test_ip_secondary_registration_if_secondary_starts_first(self):
-        with self.secondary:
-            self.assertTrue(self.secondary.was_successfully_booted(),
-                            'The secondary failed to boot: {}'.format(self.secondary.stderr))
-
-            with self.primary:
-                self.assertTrue(self.primary.was_successfully_booted(),
-                                'The primary failed to boot: {}'.format(self.primary.stderr))
+    def ecus_registered(self):
+        """
+        Return the output of aktualizr-info on the primary if all the
+        secondaries are registered, None otherwise.
+        """
+        try:
+            stdout, stderr, retcode = self.primary.command('aktualizr-info', timeout=60)
+        except subprocess.TimeoutExpired:
+            return None
+        info = stdout.decode(errors='replace')
+        if retcode != 0 or 'Provisioned on server: yes' not in info:
+            return None
+        not_registered_field = 'Removed or not registered ecus:'
+        not_reg_start = info.find(not_registered_field)
+        for hwid, serial in self.secondary_ids:
+            if info.find(hwid) == -1 or info.find(serial) == -1:
+                return None
+            if not_reg_start != -1 and info.find(serial, not_reg_start) != -1:
+                return None
+        return info
+
+    def verify_registration(self):
+        journal = self.primary.watch_journal('aktualizr')
+        try:
+            registered = journal.wait_until(self.ecus_registered, timeout=620)
+            self.assertTrue(registered, "The secondaries weren't registered at the primary: {}"
+                            .format(journal.log_tail()))
+        finally:
+            journal.stop()
 
-                self.assertTrue(self.primary.is_ecu_registered(self.secondary.id),
-                                "The secondary wasn't registered at the primary: {}".format(self.primary.get_info()))
+    def test_ip_secondary_registration_if_secondary_starts_first(self):
+        self.topology.start(self.secondaries, self.primary)
+        self.verify_registration()
 
     def test_ip_secondary_registration_if_primary_starts_first(self):
-        with self.primary:
-            self.assertTrue(self.primary.was_successfully_booted(),
-                            'The primary failed to boot: {}'.format(self.primary.stderr))
-
-            with self.secondary:
-                self.assertTrue(self.secondary.was_successfully_booted(),
-                                'The secondary failed to boot: {}'.format(self.secondary.stderr))
-
-                self.assertTrue(self.primary.is_ecu_registered(self.secondary.id),
-                                "The secondary wasn't registered at the primary: {}".format(self.primary.get_info()))
+        self.topology.start(self.primary, self.secondaries)
+        self.verify_registration()
 
 
 class ResourceControlTests(OESelftestTestCase):
+    image_variant = ImageVariant([
+        'SOTA_CLIENT_PROV = " aktualizr-shared-prov "',
+        'IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"',
+        'IMAGE_INSTALL:append = " aktualizr-resource-control "',
+        'RESOURCE_CPU_WEIGHT:pn-aktualizr = "1000"',
+        'RESOURCE_MEMORY_HIGH:pn-aktualizr = "50M"',
+        'RESOURCE_MEMORY_MAX:pn-aktualizr = "1M"',
+    ], layers=['meta-updater-qemux86-64'])
+
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
-        self.append_config('MACHINE = "qemux86-64"')
-        self.append_config('SOTA_CLIENT_PROV = " aktualizr-shared-prov "')
-        self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
-        self.append_config('IMAGE_INSTALL:append = " aktualizr-resource-control "')
-        self.append_config('RESOURCE_CPU_WEIGHT:pn-aktualizr = "1000"')
-        self.append_config('RESOURCE_MEMORY_HIGH:pn-aktualizr = "50M"')
-        self.append_config('RESOURCE_MEMORY_MAX:pn-aktualizr = "1M"')
-        self.qemu, self.s = qemu_launch(machine='qemux86-64')
+        self.qemu, self.s = qemu_launch_variant(self, self.image_variant)
 
     def tearDownLocal(self):
         qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -469,7 +447,7 @@ class ResourceControlTests(OESelftestTestCase):
     def test_aktualizr_resource_control(self):
         print('Checking aktualizr was killed')
         ran_ok = False
-        for delay in [5, 5, 5, 5]:
+        for delay in backoff_delays(20):
             sleep(delay)
             try:
                 stdout, stderr, retcode = self.qemu_command('systemctl --no-pager show aktualizr')
@@ -492,25 +470,18 @@ class ResourceControlTests(OESelftestTestCase):
 
 
 class NonSystemdTests(OESelftestTestCase):
+    image_variant = ImageVariant([
+        'SOTA_CLIENT_PROV = " aktualizr-shared-prov "',
+        'IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"',
+        'DISTRO = "poky-sota"',
+        'IMAGE_INSTALL:remove = "aktualizr-resource-control"',
+    ], layers=['meta-updater-qemux86-64'])
+
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
-        self.append_config('MACHINE = "qemux86-64"')
-        self.append_config('SOTA_CLIENT_PROV = " aktualizr-shared-prov "')
-        self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
-        self.append_config('DISTRO = "poky-sota"')
-        self.append_config('IMAGE_INSTALL:remove = "aktualizr-resource-control"')
-        self.qemu, self.s = qemu_launch(machine='qemux86-64')
+        self.qemu, self.s = qemu_launch_variant(self, self.image_variant)
 
     def tearDownLocal(self):
         qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -523,7 +494,6 @@ class NonSystemdTests(OESelftestTestCase):
         stdout, stderr, retcode = self.qemu_command('aktualizr --run-mode once')
         self.assertEqual(retcode, 0, 'Failed to run aktualizr: ' + str(stdout) + str(stderr))
 
-        machine = get_bb_var('MACHINE', 'core-image-minimal')
-        verifyProvisioned(self, machine)
+        verifyProvisioned(self, self.image_variant.machine)
 
 # vim:set ts=4 sw=4 sts=4 expandtab:
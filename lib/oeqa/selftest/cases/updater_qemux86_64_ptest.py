@@ -1,47 +1,49 @@
 # pylint: disable=C0111,C0325
+import os
 import re
 
 from oeqa.selftest.case import OESelftestTestCase
-from oeqa.utils.commands import runCmd
-from testutils import metadir, qemu_launch, qemu_send_command, qemu_terminate
+from qemufleet import QemuFleet
+from testutils import require_layers, qemu_bake_image
+
+# The ptests are split over this many guests, each running its share of
+# them with the parallel level of run-ptest.
+PTEST_GUESTS = max(1, min(4, (os.cpu_count() or 1) // 2))
 
 
 class PtestTests(OESelftestTestCase):
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        require_layers('meta-updater-qemux86-64')
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SYSTEMD_AUTO_ENABLE:aktualizr = "disable"')
         self.append_config('PTEST_ENABLED:pn-aktualizr = "1"')
         self.append_config('IMAGE_INSTALL:append = " aktualizr-ptest ptest-runner "')
         self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
-        self.qemu, self.s = qemu_launch(machine='qemux86-64', mem="768M")
-
-    def tearDownLocal(self):
-        qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
-
-    def qemu_command(self, command, timeout=60):
-        return qemu_send_command(self.qemu.ssh_port, command, timeout=timeout)
+        qemu_bake_image('core-image-minimal')
 
-    def test_run_ptests(self):
+    def run_shard(self, guest, shard):
         # simulate a login shell, so that /usr/sbin is in $PATH (from /etc/profile)
-        stdout, stderr, retcode = self.qemu_command('sh -l -c ptest-runner', timeout=None)
+        stdout, stderr, retcode = guest.command('AKTUALIZR_PTEST_CTEST_ARGS="-I %d,,%d" sh -l -c ptest-runner' %
+                                                (shard + 1, PTEST_GUESTS), timeout=None)
         output = stdout.decode()
-        print(output)
-
-        has_failure = re.search('^FAIL', output, flags=re.MULTILINE) is not None
-        if has_failure:
-            print("Full test suite log:")
-            stdout, _, _ = self.qemu_command('cat /tmp/aktualizr-ptest.log || cat /tmp/aktualizr-ptest.log.tmp', timeout=None)
-            print(stdout.decode(errors='replace'))
+        log = ''
+        if re.search('^FAIL', output, flags=re.MULTILINE) is not None:
+            stdout, _, _ = guest.command('cat /tmp/aktualizr-ptest.log || cat /tmp/aktualizr-ptest.log.tmp',
+                                         timeout=None)
+            log = stdout.decode(errors='replace')
+        return output, retcode, log
 
-        self.assertEqual(retcode, 0)
+    def test_run_ptests(self):
+        with QemuFleet('core-image-minimal', PTEST_GUESTS, machine='qemux86-64', mem="768M") as fleet:
+            results = fleet.map(self.run_shard, range(PTEST_GUESTS))
+
+        has_failure = False
+        for shard, (output, retcode, log) in enumerate(results):
+            print(output)
+            if log:
+                has_failure = True
+                print("Full test suite log of part %d of %d:" % (shard + 1, PTEST_GUESTS))
+                print(log)
+            self.assertEqual(retcode, 0)
         self.assertFalse(has_failure)
@@ -1,13 +1,12 @@
 # pylint: disable=C0111,C0325
 import os
 import logging
-import re
 import unittest
 
 from oeqa.selftest.case import OESelftestTestCase
-from oeqa.utils.commands import runCmd, bitbake, get_bb_var
+from oeqa.utils.commands import runCmd, bitbake
 
-from testutils import metadir
+from testutils import require_layers, get_bb_var
 
 
 class RpiTests(OESelftestTestCase):
@@ -15,29 +14,11 @@ class RpiTests(OESelftestTestCase):
     def setUpLocal(self):
         # Add layers before changing the machine type, otherwise the sanity
         # checker complains loudly.
-        layer:rpi = "meta-raspberrypi"
-        layer_upd:rpi = "meta-updater-raspberrypi"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer_rpi, result.output) is None:
-            self.meta_rpi = metadir() + layer_rpi
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_rpi)
-        else:
-            self.meta_rpi = None
-        if re.search(layer_upd_rpi, result.output) is None:
-            self.meta_upd_rpi = metadir() + layer_upd_rpi
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_upd_rpi)
-        else:
-            self.meta_upd_rpi = None
+        require_layers('meta-raspberrypi', 'meta-updater-raspberrypi')
 
         self.append_config('MACHINE = "raspberrypi3"')
         self.append_config('SOTA_CLIENT_PROV = " aktualizr-shared-prov "')
 
-    def tearDownLocal(self):
-        if self.meta_upd_rpi:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_upd_rpi, ignore_status=True)
-        if self.meta_rpi:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_rpi, ignore_status=True)
-
     def test_build(self):
         logger = logging.getLogger("selftest")
         logger.info('Running bitbake to build core-image-minimal')
@@ -1,16 +1,139 @@
-import sys
-from random import seed, randint
+from argparse import ArgumentParser
+from itertools import chain
+import os
+import random
+
+BLOCK_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+PROFILES = ['random', 'mutate', 'append', 'shift']
+
+
+def random_blocks(size, seed=42, block_size=BLOCK_SIZE):
+    """
+    Yield 'size' bytes of deterministic pseudo-random content in blocks of
+    at most 'block_size' bytes. The same seed always gives the same stream,
+    independently of the block size as long as it is a multiple of 4.
+    """
+    rng = random.Random(seed)
+    remaining = size
+    while remaining > 0:
+        n = min(block_size, remaining)
+        yield rng.randbytes(n)
+        remaining -= n
+
+
+def mutated_blocks(size, seed, change_seed, percent, chunk_size=CHUNK_SIZE, block_size=BLOCK_SIZE):
+    """
+    Yield the content of random_blocks(size, seed) with about 'percent' % of
+    its 'chunk_size' chunks replaced by content from 'change_seed'.
+    'chunk_size' has to divide 'block_size'.
+    """
+    select = random.Random('%s-select' % change_seed)
+    changes = random.Random(change_seed)
+    for block in random_blocks(size, seed, block_size):
+        block = bytearray(block)
+        for start in range(0, len(block), chunk_size):
+            if select.random() * 100 < percent:
+                end = min(start + chunk_size, len(block))
+                block[start:end] = changes.randbytes(end - start)
+        yield bytes(block)
+
+
+def profile_blocks(profile, size, seed, change_seed, percent=0, base_size=0, shift=0,
+                   chunk_size=CHUNK_SIZE, block_size=BLOCK_SIZE):
+    """
+    Yield the content for a payload profile, derived from the 'random'
+    content with the same seed so that consecutive versions share data:
+
+    random: 'size' bytes from 'seed'.
+    mutate: the random content with 'percent' % of the chunks changed.
+    append: the first 'base_size' bytes of the random content followed by
+            new content up to 'size' bytes.
+    shift:  'shift' bytes of new content followed by the random content,
+            i.e. everything moved by 'shift' bytes.
+    """
+    if profile == 'random':
+        return random_blocks(size, seed, block_size)
+    if profile == 'mutate':
+        return mutated_blocks(size, seed, change_seed, percent, chunk_size, block_size)
+    if profile == 'append':
+        base_size = min(base_size, size)
+        return chain(random_blocks(base_size, seed, block_size),
+                     random_blocks(size - base_size, change_seed, block_size))
+    if profile == 'shift':
+        shift = min(shift, size)
+        return chain(random_blocks(shift, change_seed, block_size),
+                     random_blocks(size - shift, seed, block_size))
+    raise ValueError('Unknown profile: %s' % profile)
+
+
+def write_files(path, blocks, size, files):
+    """
+    Write the content to 'path', or split it over 'files' files of equal
+    size named part-0000, part-0001, ... in the directory 'path'.
+    """
+    if files <= 1:
+        with open(path, 'wb') as f:
+            for block in blocks:
+                f.write(block)
+        return
+
+    os.makedirs(path, exist_ok=True)
+    part_size = -(-size // files)
+    part = 0
+    f = open(os.path.join(path, 'part-%04d' % part), 'wb')
+    written = 0
+    try:
+        for block in blocks:
+            view = memoryview(block)
+            while view:
+                if written == part_size:
+                    f.close()
+                    part += 1
+                    f = open(os.path.join(path, 'part-%04d' % part), 'wb')
+                    written = 0
+                n = min(part_size - written, len(view))
+                f.write(view[:n])
+                view = view[n:]
+                written += n
+    finally:
+        f.close()
+
 
 def main():
-    n = int(sys.argv[2])
-    ba = bytearray(n)
+    parser = ArgumentParser(description='Write a file of seeded random content')
+    parser.add_argument('file', help='output file, or output directory with --files')
+    parser.add_argument('size', type=int, help='size of the content in bytes')
+    parser.add_argument('--seed', type=int, default=42, help='random seed (default: %(default)s)')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE,
+                        help='size of the blocks generated and written at once (default: %(default)s)')
+    parser.add_argument('--profile', choices=PROFILES, default='random',
+                        help='how the content differs from the plain random content of the same seed '
+                             '(default: %(default)s)')
+    parser.add_argument('--change-seed', type=int, default=None,
+                        help='random seed of the changed content (default: seed + 1)')
+    parser.add_argument('--percent', type=float, default=10,
+                        help='mutate: percentage of chunks to change (default: %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='mutate: size of the changed chunks (default: %(default)s)')
+    parser.add_argument('--base-size', type=int, default=0,
+                        help='append: size of the unchanged content before the new tail')
+    parser.add_argument('--shift', type=int, default=4096,
+                        help='shift: number of bytes the content is moved by (default: %(default)s)')
+    parser.add_argument('--files', type=int, default=1,
+                        help='split the content over this many files (default: %(default)s)')
+    args = parser.parse_args()
+    if args.block_size <= 0 or args.block_size % 4:
+        parser.error('block size must be a positive multiple of 4')
+    if args.profile == 'mutate' and (args.chunk_size <= 0 or args.block_size % args.chunk_size):
+        parser.error('chunk size must divide the block size')
+    change_seed = args.change_seed if args.change_seed is not None else args.seed + 1
 
-    seed(42)
-    for i in range(0, n):
-       ba[i] = randint(0, 255)
+    blocks = profile_blocks(args.profile, args.size, args.seed, change_seed,
+                            percent=args.percent, base_size=args.base_size, shift=args.shift,
+                            chunk_size=args.chunk_size, block_size=args.block_size)
+    write_files(args.file, blocks, args.size, args.files)
 
-    with open(sys.argv[1], 'wb') as f:
-        f.write(bytes(ba))
 
 if __name__ == "__main__":
     main()
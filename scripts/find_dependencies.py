@@ -1,15 +1,26 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
+import codecs
+from collections import deque
+from contextlib import contextmanager
+import hashlib
+import itertools
+import json
+import os
 import os.path
 import sys
+import tempfile
+import time
 
 scripts_path = os.path.dirname(os.path.realpath(__file__))
 bb_lib_path = os.path.abspath(scripts_path + '/../../poky/bitbake/lib')
 sys.path = sys.path + [bb_lib_path]
 
+import bb.cache
 import bb.fetch2
 import bb.tinfoil
+import bb.utils
 
 
 PRINT_PROGRESS = True
@@ -34,6 +45,74 @@ KNOWN_BUILD_TOOLS = ['virtual/x86_64-poky-linux-gcc', # gcc-cross-x86_64
                      'util-linux-native',
                      'pkgconfig-native',
                      'makedepend-native']
+# Bump whenever the layout of a cached Recipe changes.
+CACHE_VERSION = 1
+CACHE_MAX_ENTRIES = 4096
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+
+class Recipe(object):
+    """
+    Snapshot of the recipe variables needed to write a manifest entry.
+
+    Reading variables through tinfoil costs a round-trip to the bitbake server
+    each time, so everything is extracted once right after parsing.
+    """
+
+    def __init__(self, pn, pv, license, summary, description, homepage,
+                 srcrev, branch, sources, depends, files=()):
+        self.pn = pn
+        self.pv = pv
+        self.license = license
+        self.summary = summary
+        self.description = description
+        self.homepage = homepage
+        self.srcrev = srcrev
+        self.branch = branch
+        # List of (type, location) pairs with SRC_URI options stripped and
+        # file:// entries already resolved to a local path.
+        self.sources = sources
+        self.depends = depends
+        # Files the parsed values were derived from: the recipe, its
+        # bbappends and everything they include or inherit.
+        self.files = list(files)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def metadata_hash(self):
+        """
+        Hash of everything that ends up in the manifest entry, used to spot
+        packages whose metadata changed between two manifests.
+        """
+        values = [self.pn, self.pv, self.license, self.summary, self.description,
+                  self.homepage, self.srcrev, self.branch, self.sources, self.depends]
+        return hashlib.sha256(json.dumps(values).encode()).hexdigest()
+
+    @classmethod
+    def from_dict(cls, values):
+        values = dict(values)
+        values['sources'] = [tuple(src) for src in values['sources']]
+        return cls(**values)
+
+
+def get_sources(data):
+    sources = []
+    fetch = None
+    for src in (data.getVar('SRC_URI') or '').split():
+        # Strip options.
+        # TODO: ignore files with apply=false?
+        src = src.split(';', maxsplit=1)[0]
+        src_type = src.split('://', maxsplit=1)[0]
+        if src_type == 'file':
+            # TODO: Get full path of patches and other files within the source
+            # repo, not just the filesystem?
+            if fetch is None:
+                fetch = bb.fetch2.Fetch([], data)
+            sources.append((src_type, fetch.localpath(src)))
+        else:
+            sources.append((src_type, src))
+    return sources
 
 
 def get_recipe_info(tinfoil, rn):
@@ -41,173 +120,946 @@ def get_recipe_info(tinfoil, rn):
         info = tinfoil.get_recipe_info(rn)
     except Exception:
         print('Failed to get recipe info for: %s' % rn)
-        return []
+        return None
     if not info:
         print('No recipe info found for: %s' % rn)
+        return None
+    return info
+
+
+def get_included_files(data):
+    # bitbake records every file pulled in by include/require/inherit, along
+    # with its mtime, in __depends.
+    try:
+        depends = data.getVar('__depends', False) or []
+    except Exception:
         return []
-    append_files = tinfoil.get_file_appends(info.fn)
+    return [dep[0] for dep in depends]
+
+
+def parse_recipe_data(tinfoil, info, append_files):
     appends = True
-    data = tinfoil.parse_recipe_file(info.fn, appends, append_files)
-    data.pn = info.pn
-    data.pv = info.pv
-    return data
+    return tinfoil.parse_recipe_file(info.fn, appends, append_files)
 
 
-def print_package(manifest_file, data, is_project):
-    src_uri = data.getVar('SRC_URI').split()
-    lic = data.getVar('LICENSE')
-    summary = data.getVar('SUMMARY')
-    homepage = data.getVar('HOMEPAGE')
-    srcrev = data.getVar('SRCREV')
-    branch = data.getVar('BRANCH')
+def parse_recipe(tinfoil, info, append_files, data=None):
+    if data is None:
+        data = parse_recipe_data(tinfoil, info, append_files)
+    return Recipe(pn=info.pn,
+                  pv=info.pv,
+                  license=data.getVar('LICENSE'),
+                  summary=data.getVar('SUMMARY'),
+                  description=data.getVar('DESCRIPTION'),
+                  homepage=data.getVar('HOMEPAGE'),
+                  srcrev=data.getVar('SRCREV'),
+                  branch=data.getVar('BRANCH'),
+                  sources=get_sources(data),
+                  depends=(data.getVar('DEPENDS') or '').split(),
+                  files=[info.fn] + list(append_files) + get_included_files(data))
 
+
+def file_stamp(path):
+    # Variants such as native recipes are named virtual:<variant>:<file>.
+    path = bb.cache.virtualfn2realfn(path)[0]
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class RecipeCache(object):
+    """
+    Persistent cache of parsed Recipe snapshots, shared between runs.
+
+    Entries are addressed by a hash of the configuration, the recipe file and
+    its bbappends (path, mtime and size of each). Every entry also records the
+    stamps of all files included by the recipe and is discarded if any of
+    them changed since. The least recently used entries are pruned once the
+    cache grows beyond max_entries.
+    """
+
+    def __init__(self, cache_dir, config_hash, max_entries=CACHE_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.config_hash = config_hash
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, fn, append_files):
+        h = hashlib.sha256()
+        h.update(('%d\0%s\0' % (CACHE_VERSION, self.config_hash)).encode())
+        for path in [fn] + list(append_files):
+            h.update(json.dumps([path, file_stamp(path)]).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        for dep_path, stamp in entry['stamps']:
+            if file_stamp(dep_path) != stamp:
+                # Another run may have removed the stale entry already.
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self.misses += 1
+                return None
+        # Mark as recently used for pruning.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return Recipe.from_dict(entry['recipe'])
+
+    def put(self, key, recipe):
+        entry = {'recipe': recipe.to_dict(),
+                 'stamps': [[path, file_stamp(path)] for path in recipe.files]}
+        # Write atomically so that concurrent runs never see partial entries.
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def prune(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            # Leave the entries other runs are still writing alone.
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+        entries.sort()
+        for _, path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def get_config_hash(tinfoil):
+    """
+    Fingerprint of the configuration the recipes are parsed with: the
+    configuration files bitbake read and the main variables that may also come
+    from the environment.
+    """
+    config_data = tinfoil.config_data
+    h = hashlib.sha256()
+    try:
+        base_depends = config_data.getVar('__base_depends', False) or []
+    except Exception:
+        base_depends = []
+    for dep in base_depends:
+        h.update(json.dumps([dep[0], file_stamp(dep[0])]).encode())
+    for var in ['MACHINE', 'DISTRO', 'DISTRO_VERSION', 'TCLIBC', 'TUNE_PKGARCH', 'BBLAYERS']:
+        h.update(('%s=%s\0' % (var, config_data.getVar(var))).encode())
+    return h.hexdigest()
+
+
+class RecipeGraph(object):
+    """
+    Graph of Recipe snapshots, keyed by dependency name, which the manifest
+    emitters walk. Subclasses fill in recipes.
+    """
+
+    def __init__(self, assume_provided):
+        # Dependency name -> reason why it is not followed.
+        self.assume_provided = dict(assume_provided)
+        # Dependency name -> Recipe, or None if it could not be resolved.
+        self.recipes = {}
+        # Dependency name -> filtered dependency names, once fully resolved.
+        self.edges = {}
+        # Pruned dependency name -> names of the recipes depending on it.
+        self.pruned = {}
+        self.parse_time = 0.0
+
+    def depends(self, rn):
+        edges = self.edges.get(rn)
+        if edges is None:
+            recipe = self.recipes.get(rn)
+            if recipe is None:
+                return []
+            edges = [dep for dep in recipe.depends
+                     if dep not in self.assume_provided and self.recipes.get(dep, True) is not None]
+            # Only memoize once all dependencies have been looked up.
+            if all(dep in self.recipes for dep in edges):
+                self.edges[rn] = edges
+        return edges
+
+    def closure(self, rn):
+        """
+        Return the dependency names of all distinct recipes reachable from a
+        resolved recipe, excluding the recipe itself, in breadth-first order.
+        """
+        seen = set([id(self.recipes[rn])])
+        packages = []
+        level = [rn]
+        while level:
+            next_level = []
+            for name in level:
+                for dep in self.depends(name):
+                    recipe = self.recipes[dep]
+                    if id(recipe) not in seen:
+                        seen.add(id(recipe))
+                        packages.append(dep)
+                        next_level.append(dep)
+            level = next_level
+        return packages
+
+    def find_cycles(self, rn):
+        """
+        Return every dependency cycle reachable from a resolved recipe as a
+        list of dependency names, the first recipe repeated at the end.
+        """
+        cycles = []
+        # id(Recipe) -> True while on the current path, False once finished.
+        on_path = {id(self.recipes[rn]): True}
+        path = [rn]
+        stack = [iter(self.depends(rn))]
+        while stack:
+            dep = next(stack[-1], None)
+            if dep is None:
+                stack.pop()
+                on_path[id(self.recipes[path.pop()])] = False
+                continue
+            recipe = self.recipes[dep]
+            state = on_path.get(id(recipe))
+            if state:
+                start = [self.recipes[name] is recipe for name in path].index(True)
+                cycles.append(path[start:] + [dep])
+            elif state is None:
+                on_path[id(recipe)] = True
+                path.append(dep)
+                stack.append(iter(self.depends(dep)))
+        return cycles
+
+
+class DependencyGraph(RecipeGraph):
+    """
+    Memoized DEPENDS graph. Every recipe file is parsed at most once, no
+    matter how many times or under how many provider names (e.g.
+    virtual/libc and glibc) it shows up in the dependency tree.
+    """
+
+    def __init__(self, tinfoil, assume_provided, cache=None):
+        super(DependencyGraph, self).__init__(assume_provided)
+        self.tinfoil = tinfoil
+        self.cache = cache
+        # Recipe file -> Recipe.
+        self.parsed = {}
+
+    def parse_batch(self, names):
+        for rn in names:
+            info = get_recipe_info(self.tinfoil, rn)
+            if info is None:
+                self.recipes[rn] = None
+                continue
+            if info.fn in self.parsed:
+                self.recipes[rn] = self.parsed[info.fn]
+            else:
+                self.recipes[rn] = self.parsed[info.fn] = self.load_recipe(info)
+            for dep in self.recipes[rn].depends:
+                if dep in self.assume_provided:
+                    self.pruned.setdefault(dep, set()).add(rn)
+
+    def load_recipe(self, info):
+        append_files = self.tinfoil.get_file_appends(info.fn)
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(info.fn, append_files)
+            recipe = self.cache.get(key)
+            if recipe is not None:
+                return recipe
+        start = time.monotonic()
+        recipe = parse_recipe(self.tinfoil, info, append_files)
+        self.parse_time += time.monotonic() - start
+        if key is not None:
+            self.cache.put(key, recipe)
+        return recipe
+
+    def resolve(self, rn):
+        """
+        Resolve the dependency closure of a recipe level by level, so that
+        each level is handed to parse_batch() in one go.
+        """
+        level = [rn]
+        depth = 0
+        while level:
+            self.parse_batch([name for name in level if name not in self.recipes])
+            if PRINT_PROGRESS and depth in (1, 2):
+                # Print high-order dependencies as a form of logging/progress notifcation.
+                for name in level:
+                    print('  ' * (depth - 1) + name)
+            queued = set()
+            next_level = []
+            for name in level:
+                for dep in self.depends(name):
+                    if dep not in self.recipes and dep not in queued:
+                        queued.add(dep)
+                        next_level.append(dep)
+            level = next_level
+            depth += 1
+        return self.recipes.get(rn)
+
+
+def read_pkgdata_file(path, pkg):
+    """
+    Read a pkgdata runtime file into a dict, with the package override
+    stripped from the variable names (RDEPENDS:foo -> RDEPENDS).
+    """
+    decode = codecs.getdecoder('unicode_escape')
+    values = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            key, sep, value = line.rstrip('\n').partition(': ')
+            if not sep:
+                continue
+            for suffix in (':' + pkg, '_' + pkg):
+                if key.endswith(suffix):
+                    key = key[:-len(suffix)]
+                    break
+            values[key] = decode(value)[0]
+    return values
+
+
+class PkgData(object):
+    """
+    Memoized reader for the runtime package data in PKGDATA_DIR, written by
+    do_packagedata of every recipe that has been built.
+    """
+
+    def __init__(self, pkgdata_dir):
+        self.pkgdata_dir = pkgdata_dir
+        # Runtime name -> package name with a runtime file, or None.
+        self.providers = {}
+        # Package name -> pkgdata values.
+        self.packages = {}
+
+    def lookup(self, name):
+        """
+        Map a runtime dependency to the package providing it: the package
+        itself, an RPROVIDES entry or a renamed (e.g. debian-style) package.
+        """
+        if name in self.providers:
+            return self.providers[name]
+        pkg = None
+        if os.path.exists(os.path.join(self.pkgdata_dir, 'runtime', name)):
+            pkg = name
+        else:
+            rprovides_dir = os.path.join(self.pkgdata_dir, 'runtime-rprovides', name)
+            reverse = os.path.join(self.pkgdata_dir, 'runtime-reverse', name)
+            if os.path.isdir(rprovides_dir) and os.listdir(rprovides_dir):
+                pkg = sorted(os.listdir(rprovides_dir))[0]
+            elif os.path.lexists(reverse):
+                pkg = os.path.basename(os.readlink(reverse))
+        self.providers[name] = pkg
+        return pkg
+
+    def get(self, pkg):
+        values = self.packages.get(pkg)
+        if values is None:
+            values = read_pkgdata_file(os.path.join(self.pkgdata_dir, 'runtime', pkg), pkg)
+            self.packages[pkg] = values
+        return values
+
+
+class RuntimeGraph(RecipeGraph):
+    """
+    Runtime closure of an image, built from RDEPENDS and RRECOMMENDS in
+    pkgdata rather than by parsing recipes. The closure is computed on
+    package level and then collapsed into one node per recipe (PN), so the
+    same emitters and package records can be used as for build-time
+    dependencies. Only the image recipe itself is parsed with tinfoil;
+    recipe-only information such as SRC_URI is therefore not available for
+    the other packages.
+    """
+
+    def __init__(self, pkgdata, recommends=True, bad_recommendations=()):
+        super(RuntimeGraph, self).__init__(dict.fromkeys(bad_recommendations, 'BAD_RECOMMENDATIONS'))
+        self.pkgdata = pkgdata
+        self.recommends = recommends
+
+    def runtime_depends(self, pkg, values):
+        names = list(bb.utils.explode_dep_versions2(values.get('RDEPENDS', '')))
+        if self.recommends:
+            for name in bb.utils.explode_dep_versions2(values.get('RRECOMMENDS', '')):
+                if name in self.assume_provided:
+                    self.pruned.setdefault(name, set()).add(pkg)
+                else:
+                    names.append(name)
+        return names
+
+    def depends(self, rn):
+        # BAD_RECOMMENDATIONS are package names and only apply to
+        # RRECOMMENDS, which runtime_depends() has filtered already. A recipe
+        # of the same name may still be a hard runtime dependency.
+        recipe = self.recipes.get(rn)
+        return recipe.depends if recipe is not None else []
+
+    def resolve(self, image, packages, attempt_only=()):
+        """
+        Resolve the runtime closure of the packages installed by an image.
+        image is the Recipe of the image, which becomes the root node.
+        Missing packages from attempt_only are silently skipped.
+        """
+        optional = set(attempt_only)
+        # Package -> providing packages of its runtime dependencies.
+        package_depends = {}
+        missing = set()
+        roots = []
+        queue = deque()
+        for name in list(packages) + list(attempt_only):
+            pkg = self.pkgdata.lookup(name)
+            if pkg is None:
+                if name not in optional:
+                    missing.add(name)
+            elif pkg not in package_depends:
+                package_depends[pkg] = None
+                roots.append(pkg)
+                queue.append(pkg)
+        while queue:
+            pkg = queue.popleft()
+            deps = []
+            for name in self.runtime_depends(pkg, self.pkgdata.get(pkg)):
+                dep = self.pkgdata.lookup(name)
+                if dep is None:
+                    missing.add(name)
+                    continue
+                deps.append(dep)
+                if dep not in package_depends:
+                    package_depends[dep] = None
+                    queue.append(dep)
+            package_depends[pkg] = deps
+        for name in sorted(missing):
+            print('No pkgdata found for runtime dependency: %s' % name)
+
+        # Collapse packages into their recipes.
+        recipe_of = {}
+        for pkg in package_depends:
+            values = self.pkgdata.get(pkg)
+            pn = values.get('PN', pkg)
+            recipe_of[pkg] = pn
+            recipe = self.recipes.get(pn)
+            if recipe is None:
+                recipe = Recipe(pn=pn,
+                                pv=values.get('PV', ''),
+                                license=values.get('LICENSE'),
+                                summary=values.get('SUMMARY'),
+                                description=values.get('DESCRIPTION'),
+                                homepage=None,
+                                srcrev=None,
+                                branch=None,
+                                sources=[],
+                                depends=[])
+                self.recipes[pn] = recipe
+            elif not recipe.license:
+                recipe.license = values.get('LICENSE')
+            elif values.get('LICENSE') and values['LICENSE'] not in recipe.license.split(' & '):
+                # Packages of one recipe may have different licenses.
+                recipe.license += ' & ' + values['LICENSE']
+        for pkg, deps in package_depends.items():
+            recipe = self.recipes[recipe_of[pkg]]
+            for dep in deps:
+                pn = recipe_of[dep]
+                if pn != recipe.pn and pn not in recipe.depends:
+                    recipe.depends.append(pn)
+
+        root = Recipe.from_dict(image.to_dict())
+        root.depends = list(dict.fromkeys(recipe_of[pkg] for pkg in roots))
+        self.recipes[root.pn] = root
+        return root
+
+
+def resolve_image(tinfoil, pkgdata, rn, recommends=True):
+    """
+    Parse an image recipe and return the RuntimeGraph of the packages it
+    installs, or None if the image cannot be found.
+    """
+    info = get_recipe_info(tinfoil, rn)
+    if info is None:
+        return None
+    append_files = tinfoil.get_file_appends(info.fn)
+    data = parse_recipe_data(tinfoil, info, append_files)
+    if data.getVar('NO_RECOMMENDATIONS') == '1':
+        recommends = False
+    graph = RuntimeGraph(pkgdata, recommends, (data.getVar('BAD_RECOMMENDATIONS') or '').split())
+    graph.resolve(parse_recipe(tinfoil, info, append_files, data),
+                  (data.getVar('PACKAGE_INSTALL') or '').split(),
+                  (data.getVar('PACKAGE_INSTALL_ATTEMPTONLY') or '').split())
+    return graph
+
+
+def package_id(recipe):
+    return 'Yocto::%s:%s' % (recipe.pn, recipe.pv)
+
+
+def package_record(recipe, is_project=False):
+    """
+    Return the manifest entry of a recipe as a mapping, in output order.
+    """
+    record = {
+        'id': {
+            'package_manager': 'Yocto',
+            'namespace': '',
+            'name': recipe.pn,
+            'version': recipe.pv,
+        },
+        'declared_lics': [recipe.license],
+    }
     if is_project:
-        manifest_file.write('  id:\n')
-    else:
-        manifest_file.write('- id:\n')
-    manifest_file.write('    package_manager: "Yocto"\n')
-    manifest_file.write('    namespace: ""\n')
-    manifest_file.write('    name: "%s"\n' % data.pn)
-    manifest_file.write('    version: "%s"\n' % data.pv)
-    manifest_file.write('  declared_lics:\n')
-    manifest_file.write('  - "%s"\n' % lic)
-    if is_project:
-        manifest_file.write('  aliases: []\n')
-    if summary:
-        manifest_file.write('  description: "%s"\n' % summary)
-    else:
-        description = data.getVar('DESCRIPTION')
-        manifest_file.write('  description: "%s"\n' % description)
-    manifest_file.write('  homepage_url: "%s"\n' % homepage)
+        record['aliases'] = []
+    record['description'] = recipe.summary if recipe.summary else recipe.description
+    record['homepage_url'] = recipe.homepage
     # Binary artifacts almost never exist in Yocto.
-    manifest_file.write('  binary_artifact:\n')
-    manifest_file.write('    url: ""\n')
-    manifest_file.write('    hash: ""\n')
-    manifest_file.write('    hash_algorithm: ""\n')
-    manifest_file.write('  source_artifact:\n')
-    repos = []
-    for src in src_uri:
-        # Strip options.
-        # TODO: ignore files with apply=false?
-        src = src.split(';', maxsplit=1)[0]
-        src_type = src.split('://', maxsplit=1)[0]
-        if src_type == 'file':
-            # TODO: Get full path of patches and other files within the source
-            # repo, not just the filesystem?
-            fetch = bb.fetch2.Fetch([], data)
-            local = fetch.localpath(src)
-            manifest_file.write('  - "%s"\n' % local)
-        else:
-            manifest_file.write('  - "%s"\n' % src)
-            if src_type != 'http' and src_type != 'https' and src_type != 'ftp' and src_type != 'ssh':
-                repos.append(src)
+    record['binary_artifact'] = {'url': '', 'hash': '', 'hash_algorithm': ''}
+    record['source_artifact'] = [src for _, src in recipe.sources]
+    repos = [src for src_type, src in recipe.sources
+             if src_type not in ('file', 'http', 'https', 'ftp', 'ssh')]
     if len(repos) > 1:
-        print('Multiple repos for one package are not supported. Package: %s' % info.pn)
-    for repo in repos:
-        vcs_type, url = repo.split('://', maxsplit=1)
-        manifest_file.write('  vcs:\n')
+        # TODO: Actually support multiple repos here.
+        print('Multiple repos for one package are not supported. Package: %s' % recipe.pn)
+    if repos:
+        vcs_type, url = repos[0].split('://', maxsplit=1)
         if vcs_type == 'gitsm':
             vcs_type = 'git'
-        manifest_file.write('    type: "%s"\n' % vcs_type)
-        manifest_file.write('    url: "%s"\n' % url)
-        # TODO: Actually support multiple repos here:
         # TODO: catch and replace AUTOINC?
-        manifest_file.write('    revision: "%s"\n' % srcrev)
-        manifest_file.write('    branch: "%s"\n' % branch)
-
-
-def find_dependencies(manifest_file, tinfoil, assume_provided, recipe_info, packages, rn, order):
-    data = recipe_info[rn]
-    # Filter out packages from the assume_provided list.
-    depends = []
-    for dep in data.depends:
-        if dep not in assume_provided:
-            depends.append(dep)
-
-    if PRINT_PROGRESS:
-        # Print high-order dependencies as a form of logging/progress notifcation.
-        if order == 2:
-            print(rn)
-        if order == 3:
-            print('  ' + rn)
-
-    # order == 1 is for the initial recipe. We've already printed its
-    # information, so skip it.
-    if order > 1:
-        spaces = '  ' * order
-        manifest_file.write('%s- namespace: ""\n' % spaces)
-        manifest_file.write('%s  name: "%s"\n' % (spaces, data.pn))
-        manifest_file.write('%s  version: "%s"\n' % (spaces, data.pv))
+        record['vcs'] = {
+            'type': vcs_type,
+            'url': url,
+            'revision': recipe.srcrev,
+            'branch': recipe.branch,
+        }
+    return record
+
+
+# Marks the end of an exhausted iterator in write_yaml().
+_END = object()
+
+
+def yaml_scalar(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    # A JSON string is a valid double-quoted YAML scalar, including escapes.
+    return json.dumps(str(value), ensure_ascii=False)
+
+
+def write_yaml(out, key, value, indent, lead=None):
+    """
+    Write one 'key: value' entry in block style. Sequences may be given as
+    iterators; they are consumed lazily, so arbitrarily large nested values
+    can be streamed without building them in memory. lead replaces the
+    indentation of the first line and is used for sequence items.
+    """
+    if lead is None:
+        lead = ' ' * indent
+    if isinstance(value, dict):
+        out.write('%s%s:\n' % (lead, key))
+        for k, v in value.items():
+            write_yaml(out, k, v, indent + 2)
+    elif isinstance(value, (list, tuple)) or hasattr(value, '__next__'):
+        items = iter(value)
+        first = next(items, _END)
+        if first is _END:
+            out.write('%s%s: []\n' % (lead, key))
+            return
+        out.write('%s%s:\n' % (lead, key))
+        for item in itertools.chain([first], items):
+            write_yaml_item(out, item, indent)
+    else:
+        out.write('%s%s: %s\n' % (lead, key, yaml_scalar(value)))
+
+
+def write_yaml_item(out, item, indent):
+    lead = ' ' * indent + '- '
+    if isinstance(item, dict):
+        for k, v in item.items():
+            write_yaml(out, k, v, indent + 2, lead)
+            lead = None
+    else:
+        out.write('%s%s\n' % (lead, yaml_scalar(item)))
+
+
+class ManifestEmitter(object):
+    """
+    Base class for the manifest output formats. Output is written through a
+    large buffer while the dependency graph is walked, so memory use does not
+    depend on the size of the written manifest.
+    """
+
+    extension = '.yml'
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def write(self, rn):
+        path = rn + '-dependencies' + self.extension
+        with open(path, 'w', buffering=OUTPUT_BUFFER_SIZE) as out:
+            self.emit(out, rn)
+        return path
+
+    def emit(self, out, rn):
+        raise NotImplementedError
+
+
+class TreeEmitter(ManifestEmitter):
+    """
+    The original format: the whole dependency tree is inlined below the
+    project, followed by the full information of every package.
+    """
+
+    def write_dependency_tree(self, out, rn, indent):
+        """
+        Write the nested dependencies of a recipe. The tree is walked with an
+        explicit stack, so deep DEPENDS chains cannot hit the recursion limit.
+        A dependency that is already on the current path is written without
+        children and with the cycle in its errors.
+        """
+        depends = self.graph.depends(rn)
         if not depends:
-            manifest_file.write('%s  dependencies: []\n' % spaces)
+            write_yaml(out, 'dependencies', [], indent)
+            return
+        out.write('%sdependencies:\n' % (' ' * indent))
+        path = [rn]
+        on_path = set([id(self.graph.recipes[rn])])
+        stack = [(iter(depends), indent)]
+        while stack:
+            deps, indent = stack[-1]
+            dep = next(deps, None)
+            if dep is None:
+                stack.pop()
+                if stack:
+                    # Finish the item whose dependencies were just written.
+                    on_path.discard(id(self.graph.recipes[path.pop()]))
+                    write_yaml(out, 'errors', [], indent)
+                continue
+            recipe = self.graph.recipes[dep]
+            write_yaml(out, 'namespace', '', indent + 2, lead=' ' * indent + '- ')
+            write_yaml(out, 'name', recipe.pn, indent + 2)
+            write_yaml(out, 'version', recipe.pv, indent + 2)
+            if id(recipe) in on_path:
+                start = [self.graph.recipes[name] is recipe for name in path].index(True)
+                cycle = ' -> '.join(path[start:] + [dep])
+                write_yaml(out, 'dependencies', [], indent + 2)
+                write_yaml(out, 'errors', ['Dependency cycle: ' + cycle], indent + 2)
+                continue
+            children = self.graph.depends(dep)
+            if not children:
+                write_yaml(out, 'dependencies', [], indent + 2)
+                write_yaml(out, 'errors', [], indent + 2)
+                continue
+            out.write('%s  dependencies:\n' % (' ' * indent))
+            path.append(dep)
+            on_path.add(id(recipe))
+            stack.append((iter(children), indent + 2))
+
+    def emit(self, out, rn):
+        write_yaml(out, 'project', package_record(self.graph.recipes[rn], is_project=True), 0)
+        out.write('  scopes:\n')
+        write_yaml(out, 'name', 'all', 4, lead='  - ')
+        write_yaml(out, 'delivered', True, 4)
+        self.write_dependency_tree(out, rn, 4)
+        write_yaml(out, 'packages', (package_record(self.graph.recipes[p])
+                                     for p in self.graph.closure(rn)), 0)
+
+
+class DagEmitter(ManifestEmitter):
+    """
+    Compact format: every package is written once and lists its direct
+    dependencies by id instead of inlining their subtrees.
+    """
+
+    def direct_dependencies(self, rn):
+        return [package_id(self.graph.recipes[dep]) for dep in self.graph.depends(rn)]
+
+    def emit(self, out, rn):
+        project = package_record(self.graph.recipes[rn], is_project=True)
+        project['scopes'] = [{
+            'name': 'all',
+            'delivered': True,
+            'dependencies': self.direct_dependencies(rn),
+        }]
+        write_yaml(out, 'project', project, 0)
+        write_yaml(out, 'packages', self.packages(rn), 0)
+
+    def packages(self, rn):
+        for p in self.graph.closure(rn):
+            record = package_record(self.graph.recipes[p])
+            record['dependencies'] = self.direct_dependencies(p)
+            yield record
+
+
+class JsonLinesEmitter(DagEmitter):
+    """
+    One JSON object per line: the project first, then every package, each
+    referencing its direct dependencies by id.
+    """
+
+    extension = '.jsonl'
+
+    def emit(self, out, rn):
+        project = {'type': 'project'}
+        project.update(package_record(self.graph.recipes[rn], is_project=True))
+        project['dependencies'] = self.direct_dependencies(rn)
+        out.write(json.dumps(project, ensure_ascii=False) + '\n')
+        for record in self.packages(rn):
+            package = {'type': 'package'}
+            package.update(record)
+            out.write(json.dumps(package, ensure_ascii=False) + '\n')
+
+    def packages(self, rn):
+        for p in self.graph.closure(rn):
+            recipe = self.graph.recipes[p]
+            record = package_record(recipe)
+            record['dependencies'] = self.direct_dependencies(p)
+            record['metadata_hash'] = recipe.metadata_hash()
+            yield record
+
+
+def read_previous_manifest(path):
+    """
+    Read the packages of a manifest written with --format jsonl. Returns a
+    dict of package name -> (version, metadata hash).
+    """
+    packages = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get('type') == 'package':
+                packages[record['id']['name']] = (record['id']['version'], record.get('metadata_hash'))
+    return packages
+
+
+class DeltaEmitter(ManifestEmitter):
+    """
+    Write only what changed compared to a previous JSON Lines manifest:
+    added packages, removed packages, packages with a new version and
+    packages whose metadata changed without a version bump. Full records are
+    only written for added and changed packages. The output is JSON Lines if
+    the manifest format is jsonl, YAML otherwise.
+    """
+
+    def __init__(self, graph, previous, json_lines=False):
+        super(DeltaEmitter, self).__init__(graph)
+        self.previous = previous
+        self.json_lines = json_lines
+        self.extension = '-delta' + ('.jsonl' if json_lines else '.yml')
+
+    def changes(self, rn):
+        current = set()
+        for p in self.graph.closure(rn):
+            recipe = self.graph.recipes[p]
+            current.add(recipe.pn)
+            previous = self.previous.get(recipe.pn)
+            if previous is None:
+                yield 'added', recipe, None
+            elif previous[0] != recipe.pv:
+                yield 'version_changed', recipe, previous[0]
+            elif previous[1] and previous[1] != recipe.metadata_hash():
+                yield 'metadata_changed', recipe, None
+        for name in sorted(set(self.previous) - current):
+            yield 'removed', name, self.previous[name][0]
+
+    def delta_record(self, change, recipe, previous_version):
+        if change == 'removed':
+            return {'type': change,
+                    'id': {'package_manager': 'Yocto', 'namespace': '', 'name': recipe, 'version': previous_version}}
+        record = {'type': change}
+        if previous_version is not None:
+            record['previous_version'] = previous_version
+        record.update(package_record(recipe))
+        record['metadata_hash'] = recipe.metadata_hash()
+        return record
+
+    def emit(self, out, rn):
+        counts = dict.fromkeys(['added', 'removed', 'version_changed', 'metadata_changed'], 0)
+        records = self.changes(rn)
+        if self.json_lines:
+            for change, recipe, previous_version in records:
+                counts[change] += 1
+                out.write(json.dumps(self.delta_record(change, recipe, previous_version),
+                                     ensure_ascii=False) + '\n')
         else:
-            manifest_file.write('%s  dependencies:\n' % spaces)
+            write_yaml(out, 'project', {'name': rn, 'version': self.graph.recipes[rn].pv}, 0)
+
+            def counted():
+                for change, recipe, previous_version in records:
+                    counts[change] += 1
+                    yield self.delta_record(change, recipe, previous_version)
+
+            write_yaml(out, 'changes', counted(), 0)
+        print('%s: %d added, %d removed, %d version changed, %d metadata changed' %
+              (rn, counts['added'], counts['removed'], counts['version_changed'], counts['metadata_changed']))
+
+
+EMITTERS = {
+    'tree': TreeEmitter,
+    'dag': DagEmitter,
+    'jsonl': JsonLinesEmitter,
+}
+
+
+def read_recipe_list(path):
+    """
+    Read recipe names from a file, one or more per line. Empty lines and
+    lines starting with '#' are ignored.
+    """
+    recipes = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', maxsplit=1)[0]
+            recipes.extend(line.split())
+    return recipes
+
+
+class PhaseTimer(object):
+    """
+    Accumulate wall-clock time spent in the named phases of a run.
+    """
 
-    # First find all dependencies not seen yet to our master list.
-    for dep in depends:
-        if dep not in packages:
-            packages.append(dep)
-            dep_data = get_recipe_info(tinfoil, dep)
-            # Do this once now to reduce the number of bitbake calls.
-            dep_data.depends = dep_data.getVar('DEPENDS').split()
-            recipe_info[dep] = dep_data
+    def __init__(self):
+        self.phases = {}
 
-    # Then recursively analyze all of the dependencies for the current recipe.
-    for dep in depends:
-        find_dependencies(manifest_file, tinfoil, assume_provided, recipe_info, packages, dep, order + 1)
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
 
-    if order > 1:
-        manifest_file.write('%s  errors: []\n' % spaces)
+    def report(self):
+        for name, seconds in self.phases.items():
+            print('  %-10s %8.2fs' % (name, seconds))
+
+
+def report_pruned(graph):
+    if not graph.pruned:
+        return
+    edges = sum(len(dependants) for dependants in graph.pruned.values())
+    print('Pruned %d dependency edges:' % edges)
+    for dep in sorted(graph.pruned):
+        print('  %s (%s): %d' % (dep, graph.assume_provided[dep], len(graph.pruned[dep])))
 
 
 def main():
-    parser = ArgumentParser(description='Find all dependencies of a recipe.')
-    parser.add_argument('recipe', metavar='recipe', help='a recipe to investigate')
+    parser = ArgumentParser(description='Find all dependencies of one or more recipes. '
+                                        'A <recipe>-dependencies.yml (or .jsonl) manifest is written for '
+                                        'each of them.')
+    parser.add_argument('recipes', metavar='recipe', nargs='*', help='a recipe to investigate')
+    parser.add_argument('-f', '--recipe-list', metavar='FILE', action='append', default=[],
+                        help='read additional recipes from FILE, one per line; may be given multiple times')
+    parser.add_argument('--format', choices=sorted(EMITTERS), default='tree',
+                        help='manifest format: the full nested dependency tree (default), a compact '
+                             'graph referencing packages by id, or JSON Lines')
+    parser.add_argument('--runtime', action='store_true',
+                        help='treat the recipes as images and follow the RDEPENDS/RRECOMMENDS closure of the '
+                             'packages they install, read from pkgdata, instead of build-time DEPENDS; the '
+                             'packages must have been built')
+    parser.add_argument('--no-recommends', action='store_true',
+                        help='do not follow RRECOMMENDS in --runtime mode')
+    parser.add_argument('--diff', metavar='MANIFEST',
+                        help='compare with a previous manifest written with --format jsonl and only write '
+                             'the added, removed and changed packages to <recipe>-dependencies-delta.*')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory for cached recipe metadata (default: ${PERSISTENT_DIR}/find_dependencies)')
+    parser.add_argument('--cache-size', type=int, default=CACHE_MAX_ENTRIES,
+                        help='maximum number of cached recipes (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true', help='always parse recipes with tinfoil')
     args = parser.parse_args()
-    rn = args.recipe
+    recipes = list(args.recipes)
+    for path in args.recipe_list:
+        recipes.extend(read_recipe_list(path))
+    # Drop duplicates but keep the order of the command line.
+    recipes = list(dict.fromkeys(recipes))
+    if not recipes:
+        parser.error('no recipes given')
+    previous = None
+    if args.diff:
+        if len(recipes) > 1:
+            parser.error('--diff only supports a single recipe')
+        previous = read_previous_manifest(args.diff)
+
+    # All recipes share one tinfoil session and one dependency graph, so the
+    # bitbake server is started once and common dependencies are resolved
+    # only once.
+    timer = PhaseTimer()
     with bb.tinfoil.Tinfoil() as tinfoil:
-        tinfoil.prepare()
+        with timer.phase('prepare'):
+            tinfoil.prepare()
         # These are the packages that bitbake assumes are provided by the host
         # system. They do not have recipes, so searching tinfoil for them will
         # not work. Anyway, by nature they are only build tools and will not be
         # distributed in an image.
-        assume_provided = tinfoil.config_data.getVar('ASSUME_PROVIDED').split()
+        assume_provided = dict.fromkeys(tinfoil.config_data.getVar('ASSUME_PROVIDED').split(),
+                                        'ASSUME_PROVIDED')
         if SKIP_BUILD_TOOLS:
-            assume_provided.extend(KNOWN_BUILD_TOOLS)
+            for tool in KNOWN_BUILD_TOOLS:
+                assume_provided.setdefault(tool, 'KNOWN_BUILD_TOOLS')
 
-        data = get_recipe_info(tinfoil, rn)
-        if not data:
-            print('Nothing to do!')
-            return
+        cache = None
+        if not args.no_cache and not args.runtime:
+            cache_dir = args.cache_dir
+            if not cache_dir:
+                cache_dir = os.path.join(tinfoil.config_data.getVar('PERSISTENT_DIR'), 'find_dependencies')
+            cache = RecipeCache(cache_dir, get_config_hash(tinfoil), args.cache_size)
 
-        with open(rn + '-dependencies.yml', "w") as manifest_file:
-            manifest_file.write('project:\n')
-            data.depends = []
-            depends = data.getVar('DEPENDS').split()
-            for dep in depends:
-                if dep not in assume_provided:
-                    data.depends.append(dep)
-            print_package(manifest_file, data, is_project=True)
-            manifest_file.write('  scopes:\n')
-            manifest_file.write('  - name: "all"\n')
-            manifest_file.write('    delivered: true\n')
-            if not data.depends:
-                manifest_file.write('    dependencies: []\n')
-            else:
-                manifest_file.write('    dependencies:\n')
-
-            recipe_info = dict([(rn, data)])
-            packages = []
-            find_dependencies(manifest_file, tinfoil, assume_provided, recipe_info, packages, rn, order=1)
-
-            manifest_file.write('packages:\n')
+        if args.runtime:
+            pkgdata = PkgData(tinfoil.config_data.getVar('PKGDATA_DIR'))
+        else:
+            graph = DependencyGraph(tinfoil, assume_provided, cache)
+        for rn in recipes:
+            if PRINT_PROGRESS and len(recipes) > 1:
+                print('Resolving %s' % rn)
+            with timer.phase('resolve'):
+                if args.runtime:
+                    graph = resolve_image(tinfoil, pkgdata, rn, not args.no_recommends)
+                    resolved = graph is not None
+                else:
+                    resolved = graph.resolve(rn)
+            if not resolved:
+                print('Nothing to do for %s!' % rn)
+                continue
+            with timer.phase('cycles'):
+                cycles = graph.find_cycles(rn)
+            for cycle in cycles:
+                print('Dependency cycle: %s' % ' -> '.join(cycle))
+            with timer.phase('write'):
+                if previous is not None:
+                    emitter = DeltaEmitter(graph, previous, json_lines=args.format == 'jsonl')
+                else:
+                    emitter = EMITTERS[args.format](graph)
+                emitter.write(rn)
+            if args.runtime:
+                report_pruned(graph)
 
-            # Iterate through the list of packages found to print out their full
-            # information. Skip the initial recipe since we already printed it out.
-            for p in packages:
-                if p is not rn:
-                    data = recipe_info[p]
-                    print_package(manifest_file, data, is_project=False)
+        if cache:
+            cache.prune()
+            print('Recipe cache: %d hits, %d misses' % (cache.hits, cache.misses))
+        if not args.runtime:
+            report_pruned(graph)
+            print('Timing (tinfoil parsing took %.2fs of resolve):' % graph.parse_time)
+        else:
+            print('Timing:')
+        timer.report()
 
 
 if __name__ == "__main__":
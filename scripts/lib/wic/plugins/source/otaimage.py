@@ -15,9 +15,11 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
+import errno
+import fcntl
+import inspect
 import logging
 import os
-import sys
 
 from wic import WicError
 from wic.plugins.source.rawcopy import RawCopyPlugin
@@ -25,9 +27,82 @@ from wic.misc import get_bitbake_var
 
 logger = logging.getLogger('wic')
 
+# ioctl cloning a whole file on copy-on-write filesystems (btrfs, XFS).
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def _copy_range(src_fd, dst_fd, offset, length):
+    """
+    Copy 'length' bytes at 'offset' between two files, in the kernel with
+    copy_file_range() where possible.
+    """
+    end = offset + length
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(src_fd, dst_fd, min(end - offset, COPY_CHUNK_SIZE),
+                                            offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    while offset < end:
+        data = os.pread(src_fd, min(end - offset, COPY_CHUNK_SIZE), offset)
+        if not data:
+            break
+        os.pwrite(dst_fd, data, offset)
+        offset += len(data)
+
+
+def extent_copy(src, dst):
+    """
+    Copy the image 'src' to 'dst' without writing its holes. The whole file
+    is reflinked if the filesystem supports it. Otherwise only the allocated
+    extents, found with SEEK_DATA/SEEK_HOLE, are copied and the rest of
+    'dst' stays sparse. Returns the method that was used.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return 'reflink'
+        except OSError:
+            pass
+
+        size = os.fstat(src_fd).st_size
+        os.ftruncate(dst_fd, size)
+        offset = 0
+        while offset < size:
+            try:
+                data = os.lseek(src_fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Only a hole left.
+                    break
+                if e.errno != errno.EINVAL:
+                    raise
+                # No hole detection on this filesystem, copy everything.
+                _copy_range(src_fd, dst_fd, offset, size - offset)
+                return 'copy'
+            hole = os.lseek(src_fd, data, os.SEEK_HOLE)
+            _copy_range(src_fd, dst_fd, data, hole - data)
+            offset = hole
+        return 'sparse'
+
+
 class OTAImagePlugin(RawCopyPlugin):
     """
     Add an already existing filesystem image to the partition layout.
+
+    With OTA_WIC_ROOTFS = "sysroot", or --sourceparams="rootfs=sysroot",
+    the partition is instead populated directly from OTA_SYSROOT, without
+    going through the .ota-ext4 image. Its size is that of the sysroot
+    plus the partition's --extra-space and --overhead-factor, or plus
+    OTA_WIC_EXTRA_SPACE kB if that is set.
     """
 
     name = 'otaimage'
@@ -44,6 +119,34 @@ class OTAImagePlugin(RawCopyPlugin):
         image_file = image_dir + "/" + get_bitbake_var("IMAGE_LINK_NAME") + ".ota-ext4"
         return image_file if os.path.exists(image_file) else ""
 
+    @classmethod
+    def _prepare_from_sysroot(cls, part, cr_workdir, oe_builddir, native_sysroot):
+        """
+        Create the partition's filesystem straight from OTA_SYSROOT.
+        """
+        sysroot = get_bitbake_var("OTA_SYSROOT")
+        if not sysroot or not os.path.isdir(sysroot):
+            raise WicError("Couldn't find OTA_SYSROOT %s, exiting" % sysroot)
+
+        # Same filesystem options as the ota-ext4 image: the initramfs and
+        # GRUB find the root by its label, and OSTree needs many inodes.
+        if not part.label:
+            part.label = "otaroot"
+        if hasattr(part, 'mkfs_extraopts') and not part.mkfs_extraopts:
+            part.mkfs_extraopts = "-F -i 4096"
+        extra_space = get_bitbake_var("OTA_WIC_EXTRA_SPACE")
+        if extra_space:
+            part.extra_space = int(extra_space)
+
+        logger.debug('Preparing partition from sysroot %s' % (sysroot))
+        # The sysroot belongs to the image recipe, whose pseudo database
+        # records the owners and modes of its files.
+        pseudo_dir = os.path.join(os.path.dirname(sysroot), "pseudo")
+        if 'pseudo_dir' in inspect.signature(part.prepare_rootfs).parameters and os.path.isdir(pseudo_dir):
+            part.prepare_rootfs(cr_workdir, oe_builddir, sysroot, native_sysroot, False, pseudo_dir)
+        else:
+            part.prepare_rootfs(cr_workdir, oe_builddir, sysroot, native_sysroot, False)
+
     @classmethod
     def do_prepare_partition(cls, part, source_params, cr, cr_workdir,
                              oe_builddir, bootimg_dir, kernel_dir,
@@ -53,6 +156,13 @@ class OTAImagePlugin(RawCopyPlugin):
         'prepares' the partition to be incorporated into the image.
         """
 
+        mode = source_params.get('rootfs') or get_bitbake_var("OTA_WIC_ROOTFS") or "image"
+        if mode == "sysroot":
+            cls._prepare_from_sysroot(part, cr_workdir, oe_builddir, native_sysroot)
+            return
+        if mode != "image":
+            raise WicError("Unknown OTA rootfs source %s, use image or sysroot" % mode)
+
         src = cls._get_src_file("IMGDEPLOYDIR")
         if not src:
             src = cls._get_src_file("DEPLOY_DIR_IMAGE")
@@ -62,8 +172,26 @@ class OTAImagePlugin(RawCopyPlugin):
         logger.debug('Preparing partition using image %s' % (src))
         source_params['file'] = src
 
-        super(OTAImagePlugin, cls).do_prepare_partition(part, source_params,
-                                                         cr, cr_workdir, oe_builddir,
-                                                         bootimg_dir, kernel_dir,
-                                                         rootfs_dir, native_sysroot)
+        if 'skip' in source_params or 'unpack' in source_params:
+            super(OTAImagePlugin, cls).do_prepare_partition(part, source_params,
+                                                             cr, cr_workdir, oe_builddir,
+                                                             bootimg_dir, kernel_dir,
+                                                             rootfs_dir, native_sysroot)
+            return
+
+        dst = os.path.join(cr_workdir, "%s.%s" % (os.path.basename(src), part.lineno))
+        if not os.path.exists(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        method = extent_copy(src, dst)
+        logger.debug('Copied %s to %s (%s)' % (src, dst, method))
+
+        # The partition size is in kB, like 'du -Lbks' reports it.
+        filesize = (os.path.getsize(dst) + 1023) // 1024
+        if filesize > part.size:
+            part.size = filesize
+
+        if part.label and hasattr(RawCopyPlugin, 'do_image_label'):
+            RawCopyPlugin.do_image_label(part.fstype, dst, part.label)
+
+        part.source_file = dst
 
@@ -1,9 +1,15 @@
-from os.path import exists, isdir, join, realpath, abspath
-from os import listdir
+from os.path import dirname, exists, isdir, join, realpath, abspath
+from os import access, fdopen, getuid, link, listdir, makedirs, replace, stat, unlink, R_OK, W_OK
+import errno
+import fcntl
+import json
 import random
 import socket
-from shutil import copyfile
-from subprocess import check_output
+import threading
+from functools import lru_cache
+from shutil import copyfile, which
+from subprocess import check_output, DEVNULL
+from tempfile import gettempdir, mkstemp
 
 EXTENSIONS = {
     'intel-corei7-64': 'wic',
@@ -11,23 +17,164 @@ EXTENSIONS = {
 }
 
 
+# ioctl cloning a whole file on copy-on-write filesystems (btrfs, XFS).
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """
+    Make 'dst' a copy of 'src' without copying the data if possible:
+    reflink the file on filesystems that support it, hardlink it within the
+    same filesystem otherwise, and only copy it as the last resort. QEMU
+    only ever reads the backing image of an overlay, so sharing the data is
+    safe, and bitbake replaces deployed images rather than rewriting them.
+    Returns the method that was used.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+    unlink(dst)
+    try:
+        link(src, dst)
+        return 'hardlink'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    copyfile(src, dst)
+    return 'copy'
+
+
+# Number of ports scanned from the start port, enough for dozens of guests.
+PORT_RANGE = 500
+# Lock files of the reserved ports, shared by all processes of the user.
+# Ports used by other users are still skipped by the bind test.
+PORT_LOCK_DIR = join(gettempdir(), 'qemu-ota-ports-%d' % getuid())
+
+_reserved_ports = {}
+_reserved_ports_lock = threading.Lock()
+
+
+def port_is_free(port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+
 def find_local_port(start_port):
-    """"
-    Find the next free TCP port after 'start_port'.
     """
+    Find the next free TCP port after 'start_port' and reserve it.
 
-    for port in range(start_port, start_port + 10):
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.bind(('', port))
+    A port that is free now may be taken by someone else before QEMU binds
+    it, so every port handed out is reserved by locking a file named after
+    it. Other QemuCommand instances, in this process or in any other, skip
+    reserved ports. The reservation lasts until release_port() is called or
+    the process exits.
+    """
+    makedirs(PORT_LOCK_DIR, exist_ok=True)
+    with _reserved_ports_lock:
+        for port in range(start_port, start_port + PORT_RANGE):
+            if port in _reserved_ports:
+                continue
+            try:
+                lock = open(join(PORT_LOCK_DIR, '%d.lock' % port), 'a')
+            except OSError:
+                print("Skipping port %d" % port)
+                continue
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Reserved by another process.
+                lock.close()
+                continue
+            if not port_is_free(port):
+                print("Skipping port %d" % port)
+                lock.close()
+                continue
+            _reserved_ports[port] = lock
             return port
-        except socket.error:
-            print("Skipping port %d" % port)
-        finally:
-            s.close()
     raise Exception("Could not find a free TCP port")
 
 
+def release_port(port):
+    """
+    Release the reservation of a port found with find_local_port().
+    """
+    with _reserved_ports_lock:
+        lock = _reserved_ports.pop(port, None)
+    if lock is not None:
+        lock.close()
+
+
+def cpu_has_virtualization():
+    """
+    Check the CPU flags for Intel VT-x or AMD-V.
+    """
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('flags'):
+                    flags = line.split(':', 1)[1].split()
+                    return 'vmx' in flags or 'svm' in flags
+    except OSError:
+        pass
+    return False
+
+
+def qemu_accelerators(binary):
+    """
+    Return the accelerators a QEMU binary supports. Asking QEMU takes a
+    process start, so the answer is kept in a file per user, next to the
+    port reservations, and only asked again when the binary changes.
+    """
+    path = which(binary)
+    if path is None:
+        return []
+    st = stat(realpath(path))
+    key = '%s:%d:%d' % (realpath(path), st.st_size, st.st_mtime_ns)
+    cache_file = join(gettempdir(), 'qemu-ota-accel-%d.json' % getuid())
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if key not in cache:
+        try:
+            output = check_output([path, '-accel', 'help'], stderr=DEVNULL).decode()
+            # The first line is a header, e.g. "Accelerators supported in QEMU binary:"
+            cache[key] = [line.strip() for line in output.splitlines()[1:] if line.strip()]
+        except Exception:
+            cache[key] = []
+        fd, tmp = mkstemp(dir=dirname(cache_file), prefix='qemu-ota-accel-')
+        try:
+            with fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            replace(tmp, cache_file)
+        except OSError:
+            # The next run asks QEMU again.
+            unlink(tmp)
+    return cache[key]
+
+
+@lru_cache(maxsize=None)
+def kvm_usable(binary='qemu-system-x86_64'):
+    """
+    Check whether QEMU can use KVM on this host: /dev/kvm has to be
+    accessible, the CPU has to support virtualization and QEMU has to be
+    built with KVM support. The result is kept for the life of the process.
+    """
+    return (access('/dev/kvm', R_OK | W_OK) and
+            cpu_has_virtualization() and
+            'kvm' in qemu_accelerators(binary))
+
+
 def random_mac():
     """Return a random Ethernet MAC address
     @link https://www.iana.org/assignments/ethernet-numbers/ethernet-numbers.xhtml#ethernet-numbers-2
@@ -88,7 +235,7 @@ class QemuCommand(object):
                         if self.dry_run:
                             print("cp %s %s" % (uboot_path, new_uboot_path))
                         else:
-                            copyfile(uboot_path, new_uboot_path)
+                            clone_file(uboot_path, new_uboot_path)
                 uboot_path = new_uboot_path
             if not exists(uboot_path) and not (self.dry_run and not exists(self.overlay)):
                 raise ValueError("U-Boot image %s does not exist" % uboot_path)
@@ -114,7 +261,7 @@ class QemuCommand(object):
                     if self.dry_run:
                         print("cp %s %s" % (image, new_image_path))
                     else:
-                        copyfile(image, new_image_path)
+                        clone_file(image, new_image_path)
             self.image = new_image_path
         else:
             self.image = realpath(image)
@@ -132,12 +279,7 @@ class QemuCommand(object):
         else:
             self.mem = "1G"
         if args.kvm is None:
-            # Autodetect KVM using 'kvm-ok'
-            try:
-                check_output(['kvm-ok'])
-                self.kvm = True
-            except Exception:
-                self.kvm = False
+            self.kvm = kvm_usable()
         else:
             self.kvm = args.kvm
         self.gui = not args.no_gui
@@ -149,6 +291,11 @@ class QemuCommand(object):
         if hasattr(args, 'host_forward'):
             self.host_fwd = args.host_forward
 
+        # Human monitor on a unix socket, and a migration stream to resume
+        # a saved guest from, for the boot snapshots of the tests.
+        self.monitor = getattr(args, 'monitor', None)
+        self.incoming = getattr(args, 'incoming', None)
+
     def command_line(self):
         netuser = 'user,hostfwd=tcp:0.0.0.0:%d-:22,restrict=off' % self.ssh_port
         if self.gdb:
@@ -191,8 +338,13 @@ class QemuCommand(object):
         else:
             cmdline += [
                     "-nographic",
-                    "-monitor", "null",
             ]
+            if not self.monitor:
+                cmdline += ["-monitor", "null"]
+        if self.monitor:
+            cmdline += ["-monitor", "unix:%s,server,nowait" % self.monitor]
+        if self.incoming:
+            cmdline += ["-incoming", self.incoming]
         if self.kvm:
             cmdline += ['-enable-kvm', '-cpu', 'host']
         else:
@@ -205,10 +357,18 @@ class QemuCommand(object):
             cmdline += ["-append", "root=/dev/vda rw highres=off console=ttyS0 ip=dhcp"]
         return cmdline
 
+    def release_ports(self):
+        """
+        Release the port reservations once QEMU is no longer running.
+        """
+        release_port(self.serial_port)
+        release_port(self.ssh_port)
+
     def img_command_line(self):
         cmdline = [
             "qemu-img", "create",
             "-o", "backing_file=%s" % self.image,
+            "-F", "raw",
             "-f", "qcow2",
             self.overlay]
         return cmdline